@@ -1,15 +1,30 @@
-import json
+import multiprocessing
 import sys
 import os
-import fitz  # PyMuPDF
-from PyQt5.QtCore import Qt, QPointF, QRectF, QSize
-from PyQt5.QtGui import QPixmap, QImage, QPolygonF, QPen, QBrush, QIcon, QFont, QColor
+from PyQt5.QtCore import Qt, QPointF, QRectF, QSize, QEvent, QTimer
+from PyQt5.QtGui import QPixmap, QPolygonF, QPen, QBrush, QIcon
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QFileDialog, QVBoxLayout, QWidget, QGraphicsView, QGraphicsScene, QGraphicsRectItem,
-    QInputDialog, QGraphicsPolygonItem, QGraphicsTextItem, QHBoxLayout, QLabel, QSizePolicy
+    QInputDialog, QGraphicsPolygonItem, QHBoxLayout, QLabel, QSizePolicy, QComboBox,
+    QProgressDialog, QProgressBar, QMessageBox
 )
 import qdarktheme
 
+from render_cache import PageRenderCache, RENDER_ZOOM, FITZ_LOCK
+from annotation_overlay import AnnotationOverlay, SuggestionLayer
+from box_suggestions import suggest_regions, next_question_number
+from template_alignment import propagate_template
+from instrumentation import profiler, profiled, enable_from_environment
+from tile_renderer import TileRenderer, TILE_Z
+from workspace import MemoryBudget, Workspace
+from thumbnail_strip import ThumbnailStrip
+from disk_cache import DiskCache, CACHE_DIR
+from dataset_export import run_export
+from annotation_store import AnnotationStore, CommandLog
+from annotation_merge import AnnotationMerger
+from file_tasks import (FileTask, FileTaskRunner, open_document_job, read_annotations_job, write_annotations_job,
+                        sync_page_coordinates)
+
 
 class AnnotationApp(QMainWindow):
     def __init__(self):
@@ -19,15 +34,24 @@ class AnnotationApp(QMainWindow):
         self.setGeometry(100, 100, 1200, 900)
         self.current_page = 0
         self.pdf_document = None
-        self.annotations = {}
+        self.annotations = AnnotationStore()
+        self.history = CommandLog()  # Undo/redo of the edits made to self.annotations
         self.points = []
         self.temp_lines = []
         self.temp_rect = None
         self.selected_point_idx = None
         self.zoom_factor = 1.0
-        self.bounding_boxes = []
         self.point_items = []
-        self.text_items = {}
+        self.hovered_box = None
+        self.journal = None  # Crash-safe log of every add/delete for the open PDF
+        self.materialized_pages = set()  # Pages whose journal events are already in self.annotations
+        # Every open PDF keeps its own annotations, journal and page; rendered pages and overlays of all of
+        # them share one memory budget, and documents left idle are closed again
+        self.memory_budget = MemoryBudget()
+        self.workspace = Workspace(on_close=self.release_document)
+        # Renders neighbouring pages in the background, and keeps rendered pages on disk for the next session
+        self.render_cache = PageRenderCache(budget=self.memory_budget,
+                                            disk_cache=DiskCache(os.path.join(CACHE_DIR, "pages"), 2 * 1024 ** 3))
 
         # Set up the layout and scene
         self.layout = QHBoxLayout()  # Horizontal layout for main window
@@ -45,8 +69,28 @@ class AnnotationApp(QMainWindow):
         self.scene = QGraphicsScene()
         self.graphics_view.setScene(self.scene)
 
+        # Boxes and labels per page, built lazily for the visible region and reused across page flips
+        self.overlay = AnnotationOverlay(self.scene, budget=self.memory_budget)
+        self.suggestions = SuggestionLayer(self.scene, self.overlay.style)
+
+        # Sharp tiles for the visible part of the page when zoomed past the base render
+        self.tile_renderer = TileRenderer(self.scene)
+        for scroll_bar in (self.graphics_view.horizontalScrollBar(), self.graphics_view.verticalScrollBar()):
+            scroll_bar.valueChanged.connect(self.update_tiles)
+            scroll_bar.valueChanged.connect(self.update_overlay)
+
+        # Track mouse movement over the page for hover highlighting
+        self.graphics_view.viewport().setMouseTracking(True)
+        self.graphics_view.viewport().installEventFilter(self)
+        self.graphics_view.installEventFilter(self)  # Arrow keys move a selection instead of scrolling
+
         self.main_layout.addWidget(self.graphics_view)
         self.main_widget.setLayout(self.main_layout)
+
+        # Page previews beside the buttons, click one to jump straight to that page
+        self.thumbnail_strip = ThumbnailStrip(DiskCache(os.path.join(CACHE_DIR, "thumbnails"), 128 * 1024 * 1024))
+        self.thumbnail_strip.page_selected.connect(self.go_to_page)
+
         # Right side vertical button layout
         self.right_layout = QVBoxLayout()
         self.right_layout.setSpacing(15)  # Increased spacing between buttons for more room
@@ -66,16 +110,47 @@ class AnnotationApp(QMainWindow):
         self.load_pdf_button.setFixedWidth(150)  # Fix the width for consistency
         self.load_pdf_button.setFixedHeight(40)  # Set fixed height for consistency
 
+        # Switches between the PDFs opened in this session
+        self.document_selector = QComboBox()
+        self.document_selector.setFixedWidth(150)
+        self.document_selector.currentIndexChanged.connect(self.switch_document)
+
         self.load_annotations_button = QPushButton("Load Annotations")
         self.load_annotations_button.clicked.connect(self.load_annotations)
         self.load_annotations_button.setFixedWidth(150)
         self.load_annotations_button.setFixedHeight(40)
 
+        # Merges another annotator's file into the current annotations instead of appending it
+        self.merge_annotations_button = QPushButton("Merge Annotations")
+        self.merge_annotations_button.clicked.connect(self.merge_annotations_from_file)
+        self.merge_annotations_button.setFixedWidth(150)
+        self.merge_annotations_button.setFixedHeight(40)
+
         self.save_annotations_button = QPushButton("Save Annotations")
         self.save_annotations_button.clicked.connect(self.save_annotations)
         self.save_annotations_button.setFixedWidth(150)
         self.save_annotations_button.setFixedHeight(40)
 
+        self.export_dataset_button = QPushButton("Export Dataset")
+        self.export_dataset_button.clicked.connect(self.export_dataset)
+        self.export_dataset_button.setFixedWidth(150)
+        self.export_dataset_button.setFixedHeight(40)
+
+        self.suggest_boxes_button = QPushButton("Suggest Boxes")
+        self.suggest_boxes_button.clicked.connect(self.suggest_boxes)
+        self.suggest_boxes_button.setFixedWidth(150)
+        self.suggest_boxes_button.setFixedHeight(40)
+
+        self.accept_suggestions_button = QPushButton("Accept All")
+        self.accept_suggestions_button.clicked.connect(self.accept_all_suggestions)
+        self.accept_suggestions_button.setFixedWidth(150)
+        self.accept_suggestions_button.setFixedHeight(40)
+
+        self.propagate_template_button = QPushButton("Propagate Template")
+        self.propagate_template_button.clicked.connect(self.propagate_template)
+        self.propagate_template_button.setFixedWidth(150)
+        self.propagate_template_button.setFixedHeight(40)
+
         # Arrow buttons for page navigation (placed side by side) with fixed size
         self.arrow_layout = QHBoxLayout()  # Horizontal layout for arrow buttons
 
@@ -99,9 +174,48 @@ class AnnotationApp(QMainWindow):
 
         # Add the other buttons to the right layout with spacing
         self.right_layout.addWidget(self.load_pdf_button)
+        self.right_layout.addWidget(self.document_selector)
         self.right_layout.addWidget(self.load_annotations_button)
+        self.right_layout.addWidget(self.merge_annotations_button)
         self.right_layout.addLayout(self.arrow_layout)  # Add arrow buttons layout
         self.right_layout.addWidget(self.save_annotations_button)
+        self.right_layout.addWidget(self.export_dataset_button)
+        self.right_layout.addWidget(self.suggest_boxes_button)
+        self.right_layout.addWidget(self.accept_suggestions_button)
+        self.right_layout.addWidget(self.propagate_template_button)
+
+        # Live timings of the hot paths when started with MARKIT_PROFILE=1
+        if enable_from_environment():
+            self.stats_label = QLabel()
+            self.stats_label.setStyleSheet("font-family: monospace; font-size: 11px; color: #AAAAAA;")
+            self.right_layout.addWidget(self.stats_label)
+            self.stats_timer = QTimer(self)
+            self.stats_timer.timeout.connect(self.update_stats_panel)
+            self.stats_timer.start(500)
+
+        # Close the PDFs nobody has looked at for a while
+        self.idle_timer = QTimer(self)
+        self.idle_timer.timeout.connect(self.workspace.evict_idle)
+        self.idle_timer.start(60 * 1000)
+
+        # File loading and saving run in the background, with their progress shown here
+        self.file_tasks = FileTaskRunner()
+        self.file_tasks.progress.connect(self.on_task_progress)
+        self.file_tasks.finished.connect(self.on_task_finished)
+        self.file_tasks.failed.connect(self.on_task_failed)
+        self.active_task = None
+
+        self.task_progress = QProgressBar()
+        self.task_progress.setFixedWidth(150)
+        self.task_progress.hide()
+        self.right_layout.addWidget(self.task_progress)
+
+        self.cancel_task_button = QPushButton("Cancel")
+        self.cancel_task_button.clicked.connect(self.cancel_task)
+        self.cancel_task_button.setFixedWidth(150)
+        self.cancel_task_button.setFixedHeight(40)
+        self.cancel_task_button.hide()
+        self.right_layout.addWidget(self.cancel_task_button)
 
         # Add stretch to push the powered by label down
         self.right_layout.addStretch(1)
@@ -123,6 +237,7 @@ class AnnotationApp(QMainWindow):
 
         # Add the graphics view and right sidebar to the main horizontal layout
         self.layout.addWidget(self.main_widget)
+        self.layout.addWidget(self.thumbnail_strip)
         self.layout.addWidget(self.right_widget)
 
         container = QWidget()
@@ -155,59 +270,179 @@ class AnnotationApp(QMainWindow):
         file_name, _ = QFileDialog.getOpenFileName(self, "Open Annotations File", "", "JSON Files (*.json)")
 
         if file_name:
-            with open(file_name, "r") as json_file:
-                loaded_annotations = json.load(json_file)
-
-            # Merge loaded annotations with current annotations
-            for page_number, data in loaded_annotations.items():
-                if page_number not in self.annotations:
-                    self.annotations[page_number] = {"labels": []}
-                self.annotations[page_number]["labels"].extend(data["labels"])  # Add existing labels
-
-            # Draw existing annotations on the current page
-            self.draw_existing_annotations()
+            self.start_task("load_annotations", file_name, read_annotations_job, self.pdf_document)
+
+    def load_annotations_file(self, file_name):
+        self.load_annotation_set(read_annotations_job(FileTask("load_annotations", file_name), file_name,
+                                                      self.pdf_document), os.path.basename(file_name))
+
+    def load_annotation_set(self, loaded_annotations, source_name):
+        # A PDF that was annotated before already shows its labels (replayed from the journal), and loading the
+        # saved file on top would add every box a second time. Ask whether to merge with them or replace them.
+        self.ensure_all_page_annotations()
+        if not any(self.annotations.count(page_number) for page_number in self.annotations):
+            self.merge_annotations(loaded_annotations)
+            return
+        mode = self.ask_load_mode(source_name)
+        if mode == "merge":
+            self.merge_annotation_set(loaded_annotations, source_name)
+        elif mode == "replace":
+            self.replace_annotations(loaded_annotations)
+
+    def ask_load_mode(self, source_name):
+        # "merge", "replace" or None when cancelled
+        box = QMessageBox(QMessageBox.Question, "MarkIT Annotation Tool",
+                          "This PDF already has annotations.\nMerge {} into them, skipping the boxes that are "
+                          "already there, or replace them?".format(source_name), QMessageBox.Cancel, self)
+        merge_button = box.addButton("Merge", QMessageBox.AcceptRole)
+        replace_button = box.addButton("Replace", QMessageBox.DestructiveRole)
+        box.setDefaultButton(merge_button)
+        box.exec_()
+        return {merge_button: "merge", replace_button: "replace"}.get(box.clickedButton())
+
+    def replace_annotations(self, loaded_annotations):
+        # Every current label deleted and the loaded ones added, as one command that can be undone
+        edits = [self.annotations.delete(page_number, self.annotations.uids(page_number))
+                 for page_number in list(self.annotations)]
+        edits.extend(self.annotations.add(page_number, data["labels"])
+                     for page_number, data in loaded_annotations.items())
+        self.commit_edits("Replace annotations", edits)
+
+    def merge_annotations(self, loaded_annotations):
+        # Merge loaded annotations with current annotations, as one command that can be undone
+        edits = []
+        for page_number, data in loaded_annotations.items():
+            self.ensure_page_annotations(page_number)  # Journal events first, so they are not read twice
+            edits.append(self.annotations.add(page_number, data["labels"]))
+        self.commit_edits("Load annotations", edits)
+
+    def merge_annotations_from_file(self):
+        file_name, _ = QFileDialog.getOpenFileName(self, "Merge Annotations File", "", "JSON Files (*.json)")
 
+        if file_name:
+            self.start_task("merge_annotations", file_name, read_annotations_job, self.pdf_document)
+
+    def merge_annotation_set(self, loaded_annotations, source_name):
+        # Boxes both sets have (matched by IoU) are kept once and only the rest is added, as one command that
+        # can be undone. Boxes the two sets disagree on are selected on the current page for review.
+        self.ensure_all_page_annotations()
+        merger = AnnotationMerger(["current annotations", source_name])
+        page_uids = {}
+        for page_number in self.annotations:
+            records = self.annotations.get(page_number).live()
+            merger.add_page(page_number, 0, records["position"],
+                            [self.annotations.texts[text] for text in records["text"].tolist()])
+            page_uids[page_number] = records["uid"].tolist()
+
+        edits, review = [], []
+        current_page_number = str(self.current_page + 1)
+        for page_number, data in loaded_annotations.items():
+            match = merger.merge(page_number, 1, data["labels"])
+            if len(match.added):
+                edits.append(self.annotations.add(page_number, [data["labels"][idx] for idx in match.added.tolist()]))
+            if page_number == current_page_number:
+                uids = page_uids.get(page_number, [])
+                review = [uids[row] for row in match.rows[~match.same_label].tolist()]
+                if len(match.added):
+                    review.extend(edits[-1].after["uid"][match.overlap].tolist())
+        self.commit_edits("Merge annotations", edits)
+        self.overlay.set_selected(review)
+
+        report = merger.report()
+        stats = merger.stats[1]
+        QMessageBox.information(self, "MarkIT Annotation Tool",
+                                "Merged {}: {} boxes added, {} already present.\n"
+                                "{} label disagreements and {} low-overlap conflicts ({} selected on this page).\n"
+                                "Agreement: {:.1%} of {} boxes.".format(
+                                    source_name, stats["new"] + stats["overlap_conflicts"],
+                                    stats["matched"] + stats["label_disagreements"], report["label_disagreements"],
+                                    report["overlap_conflicts"], len(review), report["agreement"], report["boxes"]))
+
+    def ensure_page_annotations(self, page_number):
+        # Pull a page's labels out of the journal the first time that page is needed
+        if self.journal is None or page_number in self.materialized_pages:
+            return
+        self.materialized_pages.add(page_number)
+        labels = self.journal.read_page(page_number)
+        if labels:
+            # Pages are always read from the journal before anything is added to them; not an undoable edit
+            self.annotations.add(page_number, labels)
+
+    @profiled("draw_existing_annotations")
     def draw_existing_annotations(self):
         page_number = str(self.current_page + 1)
-        if page_number in self.annotations:
-            for label in self.annotations[page_number]["labels"]:
-                x = label["position"]["x"]
-                y = label["position"]["y"]
-                width = label["position"]["width"]
-                height = label["position"]["height"]
-                text = label["text"]
-
-                # Create bounding box
-                rect_points = QPolygonF([
-                    QPointF(x, y),
-                    QPointF(x + width, y),
-                    QPointF(x + width, y + height),
-                    QPointF(x, y + height)
-                ])
-
-                bounding_box = QGraphicsPolygonItem(rect_points)
-                bounding_box.setBrush(QColor(255, 0, 0, 50))  # Semi-transparent red fill for better visibility
-                bounding_box.setPen(QPen(QColor(255, 0, 0), 3))  # Thicker red border
-
-                # Add the bounding box to the scene
-                self.scene.addItem(bounding_box)
-                self.bounding_boxes.append(bounding_box)
-
-                # Create text annotation
-                label_item = QGraphicsTextItem(text)
-                label_item.setFont(QFont("Arial", 13, QFont.Bold))  # Set a larger, bold font
-                label_item.setPos(x + width / 2 - label_item.boundingRect().width() / 2,
-                                  y + height / 2 - label_item.boundingRect().height() / 2)
-                label_item.setDefaultTextColor(Qt.blue)
-                # Store the mapping of bounding box to text item
-                self.text_items[bounding_box] = label_item
-                self.scene.addItem(label_item)
+        self.ensure_page_annotations(page_number)
+
+        # Reuses the page's prebuilt items when it was visited recently
+        self.overlay.attach(page_number, self.annotations.get(page_number))
+        self.update_overlay()
+
+    def update_overlay(self):
+        # Build items for labels in and around the visible region, margin of half a viewport on each side
+        visible_rect = self.graphics_view.mapToScene(self.graphics_view.viewport().rect()).boundingRect()
+        margin_x, margin_y = visible_rect.width() / 2, visible_rect.height() / 2
+        self.overlay.update_visible(visible_rect.adjusted(-margin_x, -margin_y, margin_x, margin_y))
+
+    def eventFilter(self, source, event):
+        if source is self.graphics_view and event.type() == QEvent.KeyPress and self.handle_edit_key(event):
+            return True
+        if source is self.graphics_view.viewport():
+            if event.type() == QEvent.MouseMove:
+                self.update_hover(self.graphics_view.mapToScene(event.pos()))
+            elif event.type() == QEvent.Resize:
+                # More of the page may have come into view
+                self.update_overlay()
+                self.update_tiles()
+        return super().eventFilter(source, event)
+
+    def update_hover(self, scene_pos):
+        hits = [box for box in self.overlay.at_point(scene_pos.x(), scene_pos.y()) if box.contains(scene_pos)]
+        hovered = hits[0] if hits else None
+        if hovered is self.hovered_box:
+            return
+
+        # Restore the previous box and highlight the one under the cursor
+        self.clear_hover()
+        if hovered is not None:
+            hovered.setPen(self.overlay.style.hover_pen)
+        self.hovered_box = hovered
+
+    def clear_hover(self):
+        if self.hovered_box is not None:
+            self.overlay.restore_pen(self.hovered_box)
+            self.hovered_box = None
+
+    def update_stats_panel(self):
+        lines = ["{:<18}{:>7}{:>7}".format("stage", "last", "p95")]
+        for name, stats in profiler.summary().items():
+            lines.append("{:<18}{:>7.1f}{:>7.1f}".format(name[:18], stats["last_ms"], stats["p95_ms"]))
+        lines.append("cache {:.0f}/{:.0f} MB".format(self.memory_budget.total_bytes / 2 ** 20,
+                                                     self.memory_budget.max_bytes / 2 ** 20))
+        self.stats_label.setText("\n".join(lines))
+
+    def closeEvent(self, event):
+        # Take the overlay out of the scene so tearing the scene down cannot leave it pointing at deleted items
+        self.clear_hover()
+        self.overlay.detach()
+        self.render_cache.shutdown()
+        self.tile_renderer.shutdown()
+        self.thumbnail_strip.shutdown()
+        if self.active_task is not None:
+            self.active_task.cancel()
+        self.file_tasks.shutdown()
+        self.store_document_state()
+        self.workspace.close_all()
+        if profiler.enabled:
+            profiler.write_trace()
+        super().closeEvent(event)
 
     def enterEvent(self, event):
         self.graphics_view.setCursor(Qt.CrossCursor)
         super().enterEvent(event)
 
     def keyPressEvent(self, e):
+        if self.handle_edit_key(e):
+            return
         if e.key() == Qt.Key_A:  # "A" key for previous page
             self.previous_page()
         elif e.key() == Qt.Key_D:  # "D" key for next page
@@ -216,31 +451,94 @@ class AnnotationApp(QMainWindow):
     def load_pdf(self):
         file_name, _ = QFileDialog.getOpenFileName(self, "Open PDF File", "", "PDF Files (*.pdf)")
         if file_name:
-            self.pdf_document = fitz.open(file_name)
-            self.current_page = 0
-            self.annotations = {}
-            self.load_page()
-
+            if self.workspace.find(file_name) is not None:
+                self.open_pdf(file_name)  # Already open, switching to it is instant
+            else:
+                self.start_task("open_pdf", file_name, open_document_job, self.render_cache)
+
+    def open_pdf(self, file_name):
+        # A PDF that is already open is switched to, with its annotations and page as they were left
+        session = self.workspace.find(file_name)
+        if session is None:
+            self.add_document(*open_document_job(FileTask("open_pdf", file_name), file_name, self.render_cache))
+        else:
+            self.add_document(session)
+
+    def add_document(self, session, first_page=None):
+        session = self.workspace.add(session)
+        if first_page is not None:
+            # Rendered while the document was opened, so the page shows without waiting for another render
+            self.render_cache.insert(session.key, session.current_page, RENDER_ZOOM, first_page)
+        if self.document_selector.findData(session.key) < 0:
+            self.document_selector.blockSignals(True)
+            self.document_selector.addItem(session.name, session.key)
+            self.document_selector.blockSignals(False)
+        self.activate_document(session)
+
+    def switch_document(self, index):
+        session = self.workspace.sessions.get(self.document_selector.itemData(index))
+        if session is not None and session is not self.workspace.active:
+            self.activate_document(session)
+
+    def activate_document(self, session):
+        self.store_document_state()
+        self.workspace.activate(session)  # Opens the fitz document again if it was closed while idle
+        self.pdf_document = session.document
+        self.annotations = session.annotations
+        self.journal = session.journal
+        self.history = session.history
+        self.materialized_pages = session.materialized_pages
+        self.current_page = session.current_page
+
+        self.render_cache.set_document(self.pdf_document, session.key, session.path)
+        self.tile_renderer.set_document(self.pdf_document, session.key)
+        self.thumbnail_strip.set_document(self.pdf_document, session.key, session.path)
+        self.clear_hover()
+        self.overlay.set_document(session.key)
+        self.document_selector.blockSignals(True)
+        self.document_selector.setCurrentIndex(self.document_selector.findData(session.key))
+        self.document_selector.blockSignals(False)
+        self.load_page()
+
+    def store_document_state(self):
+        # Hand the open document's state back to its session before another one takes over
+        session = self.workspace.active
+        if session is not None:
+            session.annotations = self.annotations
+            session.journal = self.journal
+            session.history = self.history
+            session.materialized_pages = self.materialized_pages
+            session.current_page = self.current_page
+
+    def release_document(self, session):
+        # The workspace closed an idle document, free its rendered pages and overlays too
+        self.render_cache.drop_document(session.key)
+        self.overlay.drop_document(session.key)
+        self.thumbnail_strip.drop_document(session.key)
+
+    @profiled("load_page")
     def load_page(self):
         if self.pdf_document:
-            page = self.pdf_document.load_page(self.current_page)
-            zoom_x = 2.0
-            zoom_y = 2.0
-            matrix = fitz.Matrix(zoom_x, zoom_y) * fitz.Matrix(self.zoom_factor, self.zoom_factor)
-            pix = page.get_pixmap(matrix=matrix)
-            qt_image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
-
-            pixmap = QPixmap.fromImage(qt_image)
-            pixmap = pixmap.scaled(1440, 2160, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-
-            self.scene.clear()  # Clear previous items
-            self.scene.addPixmap(pixmap)  # Add the new page image
+            # Rendered and fitted to 1440x2160 by the cache, usually ahead of time by the prefetch workers.
+            # This is only the base layer, deeper zoom levels are covered by the tile renderer.
+            zoom = RENDER_ZOOM
+            with profiler.span("page_image", page=self.current_page + 1):
+                qt_image = self.render_cache.get(self.current_page, zoom)
+                pixmap = QPixmap.fromImage(qt_image)
+
+            # Keep the previous page's overlay items alive, everything else is cleared
+            self.clear_hover()
+            self.overlay.detach()
+            self.suggestions.clear()  # Suggestions belong to the page they were made for
+            with profiler.span("scene.clear"):
+                self.scene.clear()  # Clear previous items
+            page_item = self.scene.addPixmap(pixmap)  # Add the new page image
+            page_item.setZValue(TILE_Z - 1)  # Keep the base layer below the zoom tiles
             self.graphics_view.setScene(self.scene)  # Set the scene in the graphics view
+            self.tile_renderer.set_page(self.current_page)
+            self.thumbnail_strip.set_current(self.current_page)
 
-            # Clear previous annotations and bounding boxes
-            self.bounding_boxes.clear()
-            self.text_items.clear()  # Clear text items as well
-
+            self.point_items = []  # Point markers were deleted along with the scene items
             self.points = []  # Clear points for new bounding box
             self.temp_lines = []  # Clear temporary lines
             self.temp_rect = None  # Clear temporary rectangle
@@ -248,6 +546,14 @@ class AnnotationApp(QMainWindow):
             # Draw existing annotations for the current page
             self.draw_existing_annotations()
 
+            # Start rendering the pages around this one so the next flip is instant
+            self.render_cache.prefetch(self.current_page, zoom)
+            self.update_tiles()
+
+    def update_tiles(self):
+        visible_rect = self.graphics_view.mapToScene(self.graphics_view.viewport().rect()).boundingRect()
+        self.tile_renderer.update_view(visible_rect, self.graphics_view.transform().m11())
+
     def commit_bounding_box(self):
         if len(self.points) == 2:
             top_left = QPointF(self.points[0])
@@ -257,51 +563,217 @@ class AnnotationApp(QMainWindow):
             rect = QRectF(top_left, bottom_right)
             rect_points = QPolygonF([rect.topLeft(), rect.topRight(), rect.bottomRight(), rect.bottomLeft()])
 
-            # Create a QGraphicsPolygonItem for the bounding box
-            bounding_box = QGraphicsPolygonItem(rect_points)
-            bounding_box.setBrush(QColor(255, 0, 0, 50))  # Semi-transparent red fill for better visibility
-            bounding_box.setPen(QPen(QColor(255, 0, 0), 3))  # Thicker red border
-
-            self.scene.addItem(bounding_box)
-
-            # Store bounding box in the list
-            self.bounding_boxes.append(bounding_box)
+            # Show the box while the label prompt is open
+            preview_box = QGraphicsPolygonItem(rect_points)
+            preview_box.setBrush(self.overlay.style.box_brush)
+            preview_box.setPen(self.overlay.style.box_pen)
+            self.scene.addItem(preview_box)
 
             # Calculate coordinates and dimensions
             x1, y1 = int(rect.topLeft().x()), int(rect.topLeft().y())
             width, height = int(rect.width()), int(rect.height())
 
             # Automatically prompt user for annotation label
-            label, ok = QInputDialog.getText(self, "Set Annotation Label", "Enter label:")
-            if ok and label:
-                page_number = str(self.current_page + 1)
-                if page_number not in self.annotations:
-                    self.annotations[page_number] = {"labels": []}
-
-                self.annotations[page_number]["labels"].append({
-                    "position": {"x": x1, "y": y1, "width": width, "height": height},
-                    "text": label
-                })
-
-                # Create the text annotation inside the bounding box
-                label_item = QGraphicsTextItem(label)
-                label_item.setFont(QFont("Arial", 13, QFont.Bold))  # Set a larger, bold font
-                label_item.setPos(x1 + width / 2 - label_item.boundingRect().width() / 2,
-                                  y1 + height / 2 - label_item.boundingRect().height() / 2)
-                label_item.setDefaultTextColor(Qt.blue)  # Set text color to white for better contrast
-
-                self.scene.addItem(label_item)
-
-                # Store the text item
-                self.text_items[bounding_box] = label_item
+            profiler.finish("click_to_prompt")
+            with profiler.span("label_prompt"):
+                label, ok = QInputDialog.getText(self, "Set Annotation Label", "Enter label:")
+            with profiler.span("commit_after_prompt"):
+                if ok and label:
+                    self.add_labels([{
+                        "position": {"x": x1, "y": y1, "width": width, "height": height},
+                        "text": label
+                    }])
+
+                # The preview is replaced by the overlay item, or dropped if the user cancels the prompt
+                self.scene.removeItem(preview_box)
+
+                # Clear temporary items after committing the bounding box
+                self.points = []
+                self.clear_temporary_items()
+            profiler.finish("mouse_to_commit", committed=bool(ok and label))
+
+    def add_labels(self, label_records):
+        # Add new labels to the current page, the journal and the overlay
+        if not label_records:
+            return
+        self.sync_coordinates(self.current_page, label_records)
+        self.commit_edits("Add labels", [self.annotations.add(str(self.current_page + 1), label_records)])
+
+    def commit_edits(self, description, edits):
+        # Every change to the annotations goes through here, so it is journaled, drawn and can be undone
+        if self.history.push(description, edits) is not None:
+            self.edits_applied(edits)
+
+    def edits_applied(self, edits):
+        if self.journal is not None:
+            # A changed label is logged as the old one deleted and the new one added
+            events = []
+            for edit in edits:
+                events.extend((edit.page_number, "delete", label) for label in self.annotations.to_labels(edit.before))
+                events.extend((edit.page_number, "add", label) for label in self.annotations.to_labels(edit.after))
+            self.journal.record_many(events)
+
+        # The overlay redraws the touched boxes with their labels
+        self.clear_hover()
+        for edit in edits:
+            self.overlay.update_labels(edit.page_number, self.annotations.get(edit.page_number), edit.uids().tolist())
+        self.update_overlay()
+
+    def undo(self):
+        self.show_edits(self.history.undo(self.annotations))
+
+    def redo(self):
+        self.show_edits(self.history.redo(self.annotations))
+
+    def show_edits(self, edits):
+        if not edits:
+            return
+        self.edits_applied(edits)
+        # Go to the page an undone edit was made on, unless it spanned several pages
+        page_numbers = {edit.page_number for edit in edits}
+        if len(page_numbers) == 1:
+            self.go_to_page(int(page_numbers.pop()) - 1)
+
+    def edit_selection(self, description, operation, *args):
+        # Apply one store operation to all selected labels of the current page as a single command
+        uids = self.overlay.selection()
+        if uids:
+            self.commit_edits(description, [operation(str(self.current_page + 1), uids, *args)])
+
+    def move_selection(self, dx, dy):
+        self.edit_selection("Move labels", self.annotations.move, dx, dy, self.page_rect(self.current_page))
+
+    def resize_selection(self, dw, dh):
+        self.edit_selection("Resize labels", self.annotations.resize, dw, dh, self.page_rect(self.current_page))
+
+    def delete_selection(self):
+        self.edit_selection("Delete labels", self.annotations.delete)
+
+    def relabel_selection(self, text=None):
+        if not self.overlay.selection():
+            return
+        if text is None:
+            text, ok = QInputDialog.getText(self, "Relabel Selection", "Enter label:")
+            if not ok:
+                return
+        if text:
+            self.edit_selection("Relabel labels", self.annotations.relabel, text)
+
+    def select_all(self):
+        self.overlay.set_selected(self.annotations.uids(str(self.current_page + 1)))
+
+    def handle_edit_key(self, event):
+        # Undo/redo and the selection shortcuts; returns whether the key was used
+        key, modifiers = event.key(), event.modifiers()
+        if modifiers & Qt.ControlModifier:
+            if key == Qt.Key_Z and modifiers & Qt.ShiftModifier or key == Qt.Key_Y:
+                self.redo()
+            elif key == Qt.Key_Z:
+                self.undo()
+            elif key == Qt.Key_A:
+                self.select_all()
             else:
-                # If the user cancels the prompt, remove the bounding box
-                self.scene.removeItem(bounding_box)
-                self.bounding_boxes.remove(bounding_box)
-
-            # Clear temporary items after committing the bounding box
-            self.points = []
-            self.clear_temporary_items()
+                return False
+            return True
+
+        if not self.overlay.selection():
+            return False
+        step = 10 if modifiers & Qt.ShiftModifier else 1
+        arrows = {Qt.Key_Left: (-step, 0), Qt.Key_Right: (step, 0), Qt.Key_Up: (0, -step), Qt.Key_Down: (0, step)}
+        if key in arrows:
+            # Alt+arrows resize (right/down grow, left/up shrink), plain arrows move
+            if modifiers & Qt.AltModifier:
+                self.resize_selection(*arrows[key])
+            else:
+                self.move_selection(*arrows[key])
+        elif key in (Qt.Key_Delete, Qt.Key_Backspace):
+            self.delete_selection()
+        elif key == Qt.Key_R:
+            self.relabel_selection()
+        elif key == Qt.Key_Escape:
+            self.overlay.clear_selection()
+        else:
+            return False
+        return True
+
+    def sync_coordinates(self, page_index, labels):
+        sync_page_coordinates(self.pdf_document, page_index, labels)
+
+    def page_rect(self, page_index):
+        with FITZ_LOCK:
+            return self.pdf_document.load_page(page_index).rect
+
+    def suggest_boxes(self):
+        if not self.pdf_document:
+            return
+        page_number = str(self.current_page + 1)
+        # Earlier pages that were never viewed this session still only live in the journal, and numbering
+        # would start over without their questions
+        self.ensure_all_page_annotations()
+        existing = self.annotations.labels(page_number)
+        with FITZ_LOCK:
+            page = self.pdf_document.load_page(self.current_page)
+            labels = suggest_regions(page, existing, next_question_number(self.annotations, self.current_page + 1))
+        self.suggestions.show(labels)
+
+    def accept_all_suggestions(self):
+        self.add_labels(self.suggestions.take_all())
+
+    def propagate_template(self):
+        # Copy the current page's labels onto every page that has none yet, aligned to each page's content
+        if not self.pdf_document:
+            return
+        template_number = str(self.current_page + 1)
+        if not self.annotations.count(template_number):
+            return
+
+        target_pages = []
+        for page_index in range(len(self.pdf_document)):
+            page_number = str(page_index + 1)
+            self.ensure_page_annotations(page_number)
+            if page_index != self.current_page and not self.annotations.count(page_number):
+                target_pages.append(page_index)
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            with FITZ_LOCK:
+                results = propagate_template(self.pdf_document, self.current_page,
+                                             self.annotations.labels(template_number), target_pages)
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        edits, skipped = [], []
+        for page_index, (labels, transform) in results.items():
+            if not transform["aligned"]:
+                skipped.append(str(page_index + 1))
+                continue
+            self.sync_coordinates(page_index, labels)
+            edits.append(self.annotations.add(str(page_index + 1), labels))
+        self.commit_edits("Propagate template", edits)
+        if skipped:
+            pages = "Page {} was".format(skipped[0]) if len(skipped) == 1 else "Pages {} were".format(", ".join(skipped))
+            QMessageBox.information(self, "MarkIT Annotation Tool",
+                                    "{} left without labels: the content does not line up with page {} "
+                                    "(blank, another layout or a failed scan).".format(pages, template_number))
+
+    def handle_suggestion_click(self, event):
+        # Left click accepts the suggestion under the cursor, right click rejects it
+        if not len(self.suggestions) or self.points or not self.graphics_view.underMouse():
+            return False
+        box = self.suggestions.at_point(self.map_click_to_scene(event.pos())[0])
+        if box is None:
+            return False
+        label_record = self.suggestions.take(box)
+        if event.button() == Qt.LeftButton:
+            self.add_labels([label_record])
+        return True
+
+    def map_click_to_scene(self, position):
+        # Mouse events arrive in window coordinates, map them through the view's viewport into the scene
+        viewport_pos = self.graphics_view.viewport().mapFrom(self, position)
+        scene_pos = self.graphics_view.mapToScene(viewport_pos)
+        scale_factor = self.graphics_view.transform().m11()  # Assumes uniform scaling
+        return scene_pos, scale_factor
 
     def next_page(self):
         if self.pdf_document and self.current_page < len(self.pdf_document) - 1:
@@ -313,33 +785,157 @@ class AnnotationApp(QMainWindow):
             self.current_page -= 1
             self.load_page()  # Load the previous page
 
+    def go_to_page(self, page_index):
+        # Jump from the thumbnail strip, only the target page gets a full render
+        if self.pdf_document and 0 <= page_index < len(self.pdf_document) and page_index != self.current_page:
+            self.current_page = page_index
+            self.load_page()
+
     def save_annotations(self):
         file_name, _ = QFileDialog.getSaveFileName(self, "Save Annotations", "", "JSON Files (*.json)")
         if file_name:
-            with open(file_name, "w") as json_file:
-                json.dump(self.annotations, json_file, indent=4)
+            self.ensure_all_page_annotations()
+            self.start_task("save_annotations", file_name, write_annotations_job, self.snapshot_annotations(),
+                            self.journal)
+
+    def ensure_all_page_annotations(self):
+        if self.journal is not None:
+            # Pages never viewed this session still only live in the journal
+            for page_number in self.journal.pages():
+                self.ensure_page_annotations(page_number)
+
+    def save_annotations_file(self, file_name):
+        self.ensure_all_page_annotations()
+        write_annotations_job(FileTask("save_annotations", file_name), file_name, self.snapshot_annotations(),
+                              self.journal)
+
+    def snapshot_annotations(self):
+        # Copies the label arrays, the writer thread builds the JSON from the copy while editing goes on
+        return self.annotations.snapshot()
+
+    def start_task(self, kind, path, job, *args):
+        # One file operation at a time; annotating and page navigation stay available meanwhile
+        self.active_task = self.file_tasks.start(kind, path, job, *args)
+        self.set_file_controls_enabled(False)
+        self.task_progress.setRange(0, 0)
+        self.task_progress.setFormat("")
+        self.task_progress.show()
+        self.cancel_task_button.show()
+
+    def set_file_controls_enabled(self, enabled):
+        for widget in (self.load_pdf_button, self.load_annotations_button, self.merge_annotations_button,
+                       self.save_annotations_button, self.export_dataset_button, self.document_selector):
+            widget.setEnabled(enabled)
+
+    def cancel_task(self):
+        if self.active_task is not None:
+            self.active_task.cancel()
+            self.task_progress.setFormat("Cancelling")
+
+    def end_task(self, task):
+        if task is not self.active_task:
+            return False
+        self.active_task = None
+        self.set_file_controls_enabled(True)
+        self.task_progress.hide()
+        self.cancel_task_button.hide()
+        return True
+
+    def on_task_progress(self, task, message, done, total):
+        if task is self.active_task and not task.cancelled:
+            self.task_progress.setRange(0, total)
+            self.task_progress.setValue(done)
+            self.task_progress.setFormat("{} %p%".format(message) if total else message)
+
+    def on_task_finished(self, task, result):
+        if not self.end_task(task) or result is None:
+            return
+        if task.kind == "open_pdf":
+            session, first_page = result
+            if task.cancelled:
+                # Cancelled after the worker was done, hand the document back
+                if session.journal is not None:
+                    session.journal.close()
+                with FITZ_LOCK:
+                    session.document.close()
+                return
+            self.add_document(session, first_page)
+        elif task.kind == "load_annotations" and not task.cancelled:
+            self.load_annotation_set(result, os.path.basename(task.path))
+        elif task.kind == "merge_annotations" and not task.cancelled:
+            self.merge_annotation_set(result, os.path.basename(task.path))
+
+    def on_task_failed(self, task, message):
+        if self.end_task(task):
+            action = {"open_pdf": "open", "load_annotations": "load", "merge_annotations": "merge",
+                      "save_annotations": "save"}[task.kind]
+            QMessageBox.warning(self, "MarkIT Annotation Tool",
+                                "Could not {} {}:\n{}".format(action, os.path.basename(task.path), message))
+
+    def export_dataset(self):
+        # Crop every labeled region of the open PDF into a sharded training dataset with COCO/YOLO labels
+        if not self.pdf_document:
+            return
+        output_dir = QFileDialog.getExistingDirectory(self, "Export Dataset")
+        if not output_dir:
+            return
+        self.ensure_all_page_annotations()
+
+        progress = QProgressDialog("Exporting labeled regions...", "Cancel", 0, 0, self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+
+        def report(pages_done, total_pages, regions_done, elapsed):
+            progress.setMaximum(total_pages)
+            progress.setValue(pages_done)
+            progress.setLabelText("Exported {} regions from {}/{} pages".format(regions_done, pages_done, total_pages))
+            QApplication.processEvents()
+
+        # Spawned rather than forked workers, a fork would copy the render threads' locks mid-render
+        try:
+            documents = [(self.workspace.active.path, self.annotations.to_dict())]
+            _, regions, _, cancelled, failed = run_export(documents, output_dir, report=report,
+                                                          cancelled=progress.wasCanceled,
+                                                          mp_context=multiprocessing.get_context("spawn"))
+        except Exception as error:
+            QMessageBox.warning(self, "MarkIT Annotation Tool", "Could not export the dataset:\n{}".format(error))
+            return
+        finally:
+            progress.close()
+        if failed:
+            QMessageBox.warning(self, "MarkIT Annotation Tool",
+                                "Some pages could not be exported:\n{}\nThe dataset in {} is incomplete and has "
+                                "no COCO or classes file.".format(
+                                    "\n".join(error for errors in failed.values() for error in errors), output_dir))
+        elif cancelled:
+            QMessageBox.information(self, "MarkIT Annotation Tool",
+                                    "Export cancelled after {} regions. The dataset in {} is incomplete and has "
+                                    "no COCO or classes file.".format(regions, output_dir))
 
     def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton and self.graphics_view.underMouse():
-            # Map the view coordinates to the scene coordinates
-            scene_pos = self.graphics_view.mapToScene(event.pos())
+        if self.handle_suggestion_click(event):
+            return
 
-            # Define adjustable offsets
-            x_offset = getattr(self, "x_offset", -20)  # Default to 0 if not set
-            y_offset = getattr(self, "y_offset", -78)  # Default to 0 if not set
+        if (event.button() == Qt.LeftButton and event.modifiers() & Qt.ControlModifier
+                and self.graphics_view.underMouse()):
+            # Ctrl+click adds the box under the cursor to the selection, or takes it out again
+            box = self.box_at(event.pos())
+            if box is not None:
+                self.overlay.toggle_selected(box)
+            return
 
-            # Adjust for zoom factor
-            scale_factor = self.graphics_view.transform().m11()  # Assumes uniform scaling
-            adjusted_pos = QPointF(scene_pos.x() + x_offset / scale_factor,
-                                   scene_pos.y() + y_offset / scale_factor)
+        if event.button() == Qt.LeftButton and self.graphics_view.underMouse():
+            scene_pos, scale_factor = self.map_click_to_scene(event.pos())
 
             if len(self.points) < 2:
-                self.points.append(adjusted_pos)  # Add the adjusted position
+                # First click starts the mouse-to-commit timing, the second one the click-to-prompt timing
+                profiler.mark("mouse_to_commit" if not self.points else "click_to_prompt")
+                self.points.append(scene_pos)  # Add the clicked scene position
 
                 # Draw point as a red circle
                 point_item = self.scene.addEllipse(
-                    adjusted_pos.x() - 3 / scale_factor,  # Adjust size for zoom
-                    adjusted_pos.y() - 3 / scale_factor,
+                    scene_pos.x() - 3 / scale_factor,  # Adjust size for zoom
+                    scene_pos.y() - 3 / scale_factor,
                     6 / scale_factor,
                     6 / scale_factor,
                     QPen(Qt.red),
@@ -356,50 +952,25 @@ class AnnotationApp(QMainWindow):
         elif event.button() == Qt.RightButton:
             self.delete_bounding_box(event.pos())
 
-    def delete_bounding_box(self, position):
-        # Map the view position to the scene position
-        pos = self.graphics_view.mapToScene(position)
+    def box_at(self, position):
+        # Map the window position to the scene position
+        scene_pos, _ = self.map_click_to_scene(position)
 
-        # Adjust for zoom factor and offset
-        scale_factor = self.graphics_view.transform().m11()  # Assumes uniform scaling
-        x_offset = getattr(self, "x_offset", -20)  # Default to 0 if not set
-        y_offset = getattr(self, "y_offset", -78)  # Default to 0 if not set
-        adjusted_pos = QPointF(pos.x() + x_offset / scale_factor,
-                               pos.y() + y_offset / scale_factor)
-
-        # Loop through the bounding boxes to check if the click position is inside any of them
-        for box in self.bounding_boxes:
-            if box.contains(adjusted_pos):
-                # Remove the bounding box from the scene and the list
-                self.scene.removeItem(box)
-                self.bounding_boxes.remove(box)
-
-                # Remove the corresponding annotation from self.annotations
-                page_number = str(self.current_page + 1)
-                if page_number in self.annotations:
-                    labels = self.annotations[page_number]["labels"]
-                    for label in labels:
-                        if self.is_bbox_match(label["position"], box):
-                            labels.remove(label)
-                            break
-
-                # Remove the associated text item
-                if box in self.text_items:
-                    text_item = self.text_items[box]
-                    self.scene.removeItem(text_item)  # Remove from scene
-                    del self.text_items[box]  # Remove from dictionary
-                break
+        # Only the boxes registered in the grid cell under the click are candidates, topmost first
+        for box in self.overlay.at_point(scene_pos.x(), scene_pos.y()):
+            if box.contains(scene_pos):
+                return box
+        return None
 
-    def is_bbox_match(self, annotation_position, box):
-        # Helper method to check if the bounding box matches the annotation position
-        box_points = [box.polygon().at(i) for i in range(4)]
-        x1, y1 = annotation_position["x"], annotation_position["y"]
-        x2, y2 = annotation_position["x"] + annotation_position["width"], annotation_position["y"] + \
-                 annotation_position["height"]
-        return (min(box_points[0].x(), box_points[2].x()) <= x1 <= max(box_points[0].x(), box_points[2].x()) and
-                min(box_points[0].y(), box_points[2].y()) <= y1 <= max(box_points[0].y(), box_points[2].y()) and
-                min(box_points[0].x(), box_points[2].x()) <= x2 <= max(box_points[0].x(), box_points[2].x()) and
-                min(box_points[0].y(), box_points[2].y()) <= y2 <= max(box_points[0].y(), box_points[2].y()))
+    @profiled("delete_bounding_box")
+    def delete_bounding_box(self, position):
+        box = self.box_at(position)
+        if box is not None:
+            if box is self.hovered_box:
+                self.hovered_box = None
+            # Delete exactly the label the box was drawn from
+            self.commit_edits("Delete label",
+                              [self.annotations.delete(str(self.current_page + 1), [self.overlay.uid_for(box)])])
 
     def select_point(self, event):
         # Select the nearest point within a threshold distance
@@ -452,9 +1023,12 @@ class AnnotationApp(QMainWindow):
             # Apply the zoom transformation to the view, not the image itself
             self.graphics_view.setTransform(
                 self.graphics_view.transform().scale(1.1 if zoom_in else 0.9, 1.1 if zoom_in else 0.9))
+            self.update_tiles()
 
 
 if __name__ == "__main__":
+    # Dataset export workers are spawned; in the frozen build they must not start another GUI
+    multiprocessing.freeze_support()
     qdarktheme.enable_hi_dpi()
     app = QApplication(sys.argv + ['-platform', 'windows:darkmode=1'])
     qdarktheme.setup_theme()
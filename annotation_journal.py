@@ -0,0 +1,140 @@
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+# Append-only JSON Lines log of annotation edits. Every line is one event:
+#   {"page": "3", "op": "add", "label": {"position": {...}, "text": "1A"}}
+# The page number is always written first so the index can be built without parsing the whole line.
+# Edits are recorded on the GUI thread while compact() may run on a file worker, the lock keeps the
+# index and the open file consistent between them.
+EVENT_PREFIX = re.compile(rb'^\{"page": "([^"]*)", "op": "(add|delete)"')
+
+
+class AnnotationJournal:
+    def __init__(self, path):
+        self.path = path
+        self.page_offsets = defaultdict(list)  # page number -> byte offsets of its events
+        self.event_count = 0
+        self.delete_count = 0
+        self.lock = threading.RLock()
+        self._build_index()
+        self.file = open(self.path, "ab")
+        self.file.seek(0, os.SEEK_END)
+
+    def _build_index(self):
+        self.page_offsets.clear()
+        self.event_count = 0
+        self.delete_count = 0
+        if not os.path.exists(self.path):
+            return
+
+        offset = 0
+        with open(self.path, "rb") as journal_file:
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    # A crash in the middle of a write leaves a partial last line, drop it
+                    break
+                match = EVENT_PREFIX.match(line)
+                if match:
+                    self.page_offsets[match.group(1).decode()].append(offset)
+                    self.event_count += 1
+                    if match.group(2) == b"delete":
+                        self.delete_count += 1
+                offset += len(line)
+
+        if offset != os.path.getsize(self.path):
+            with open(self.path, "r+b") as journal_file:
+                journal_file.truncate(offset)
+
+    def pages(self):
+        with self.lock:
+            return list(self.page_offsets)
+
+    def read_page(self, page_number):
+        # Replay only the events of one page
+        with self.lock:
+            return self._replay(list(self.page_offsets.get(page_number, ())))
+
+    def _replay(self, offsets):
+        labels = []
+        if not offsets:
+            return labels
+
+        with open(self.path, "rb") as journal_file:
+            for offset in offsets:
+                journal_file.seek(offset)
+                event = json.loads(journal_file.readline())
+                if event["op"] == "add":
+                    labels.append(event["label"])
+                elif event["label"] in labels:
+                    labels.remove(event["label"])
+        return labels
+
+    def record_add(self, page_number, label):
+        self._append([(page_number, "add", label)])
+
+    def record_delete(self, page_number, label):
+        self._append([(page_number, "delete", label)])
+
+    def record_many(self, events):
+        # events: iterable of (page_number, op, label), written with a single sync
+        self._append(events)
+
+    def _append(self, events):
+        with self.lock:
+            for page_number, op, label in events:
+                line = json.dumps({"page": page_number, "op": op, "label": label}) + "\n"
+                self.page_offsets[page_number].append(self.file.tell())
+                self.file.write(line.encode())
+                self.event_count += 1
+                if op == "delete":
+                    self.delete_count += 1
+            # Make the edit durable before returning to the UI
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def needs_compaction(self):
+        # Deleted boxes cost two lines each, compact once they are a third of the log
+        return self.delete_count * 3 > self.event_count
+
+    def compact(self):
+        # Rewrite the journal with one "add" per live label, swapping the file in atomically. Runs on a file
+        # worker while edits go on: the lock is only held to take a snapshot of the index and for the swap,
+        # and events recorded in between are copied over unchanged.
+        temp_path = self.path + ".tmp"
+        with self.lock:
+            if self.file.closed:
+                return
+            end = self.file.tell()
+            pages = {page_number: list(offsets) for page_number, offsets in self.page_offsets.items()}
+        with open(temp_path, "wb") as temp_file:
+            for page_number, offsets in pages.items():
+                for label in self._replay(offsets):
+                    temp_file.write((json.dumps({"page": page_number, "op": "add", "label": label}) + "\n").encode())
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+            with self.lock:
+                if self.file.closed:
+                    # The document was closed meanwhile, its journal stays as it is
+                    temp_file.close()
+                    os.remove(temp_path)
+                    return
+                with open(self.path, "rb") as journal_file:
+                    journal_file.seek(end)
+                    temp_file.write(journal_file.read())
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+                temp_file.close()
+                self.file.close()
+                os.replace(temp_path, self.path)
+                self._build_index()
+                self.file = open(self.path, "ab")
+                self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Merges annotation sets of the same PDF made by different annotators (or the same set loaded twice).
+# Boxes are matched page by page on their intersection over union (IoU):
+#   - a pair overlapping by at least MATCH_IOU marks the same region and is kept once; if the two
+#     labels differ it is a label disagreement and the label merged first is kept
+#   - a box without such a partner that still overlaps one by CONFLICT_IOU or more is a low-overlap
+#     conflict and is kept next to it
+#   - any other box is new and simply added
+# Files are merged one after another into the result, so only one of them is in memory at a time.
+#
+#   python annotation_merge.py merged.json annotator_1.json annotator_2.json --report agreement.json
+#
+# No Qt dependency.
+
+MATCH_IOU = 0.5
+CONFLICT_IOU = 0.1
+CHUNK_ROWS = 64  # Boxes compared with their horizontal neighbours in one vectorized step
+
+
+def position_boxes(positions):
+    # (n, 4) x, y, width, height -> x0, y0, x1, y1; boxes drawn from bottom-right to top-left have negative sizes
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 4)
+    x1 = positions[:, 0] + positions[:, 2]
+    y1 = positions[:, 1] + positions[:, 3]
+    return np.stack([np.minimum(positions[:, 0], x1), np.minimum(positions[:, 1], y1),
+                     np.maximum(positions[:, 0], x1), np.maximum(positions[:, 1], y1)], axis=1)
+
+
+def label_boxes(labels):
+    return position_boxes([(label["position"]["x"], label["position"]["y"], label["position"]["width"],
+                            label["position"]["height"]) for label in labels])
+
+
+def overlapping_pairs(boxes, others, min_iou):
+    # (rows, cols, ious) of every pair of boxes overlapping by at least min_iou. Both sets are sorted by x0
+    # so each chunk of boxes is only compared with the others in its horizontal range, and pages with
+    # thousands of boxes never need the full n x m IoU matrix.
+    rows, cols, ious = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)], [np.zeros(0)]
+    if not len(boxes) or not len(others):
+        return rows[0], cols[0], ious[0]
+    order = np.argsort(boxes[:, 0], kind="stable")
+    other_order = np.argsort(others[:, 0], kind="stable")
+    boxes, others = boxes[order], others[other_order]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    max_width = float((others[:, 2] - others[:, 0]).max())
+
+    for start in range(0, len(boxes), CHUNK_ROWS):
+        chunk = boxes[start:start + CHUNK_ROWS]
+        # Others starting further left than the widest one end before any box of the chunk starts
+        first = np.searchsorted(others[:, 0], chunk[0, 0] - max_width, side="left")
+        last = np.searchsorted(others[:, 0], chunk[:, 2].max(), side="right")
+        if first >= last:
+            continue
+        window = others[first:last]
+        width = np.minimum(chunk[:, None, 2], window[None, :, 2]) - np.maximum(chunk[:, None, 0], window[None, :, 0])
+        height = np.minimum(chunk[:, None, 3], window[None, :, 3]) - np.maximum(chunk[:, None, 1], window[None, :, 1])
+        intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+        union = areas[start:start + CHUNK_ROWS, None] + other_areas[None, first:last] - intersection
+        iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+        chunk_rows, chunk_cols = np.nonzero((intersection > 0) & (iou >= min_iou))
+        rows.append(order[start + chunk_rows])
+        cols.append(other_order[first + chunk_cols])
+        ious.append(iou[chunk_rows, chunk_cols])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(ious)
+
+
+def greedy_match(rows, cols, ious):
+    # One-to-one pairs, best overlap first
+    order = np.lexsort((cols, rows, -ious))
+    used_rows, used_cols, keep = set(), set(), []
+    for idx, row, col in zip(order.tolist(), rows[order].tolist(), cols[order].tolist()):
+        if row not in used_rows and col not in used_cols:
+            used_rows.add(row)
+            used_cols.add(col)
+            keep.append(idx)
+    keep = np.asarray(keep, dtype=np.intp)
+    return rows[keep], cols[keep], ious[keep]
+
+
+class MergedPage:
+    # Boxes merged so far on one page, and how many sources drew each of them with the same label
+    def __init__(self, boxes=None, texts=(), labels=None):
+        self.boxes = np.zeros((0, 4)) if boxes is None else boxes
+        self.texts = np.asarray(list(texts), dtype=object)
+        self.votes = np.ones(len(self.boxes), dtype=np.int32)
+        self.disputed = np.zeros(len(self.boxes), dtype=bool)
+        self.labels = labels  # Label dicts of the merged boxes when building a merged file
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def append(self, boxes, texts, labels):
+        self.boxes = np.concatenate([self.boxes, boxes])
+        self.texts = np.concatenate([self.texts, texts])
+        self.votes = np.concatenate([self.votes, np.ones(len(boxes), dtype=np.int32)])
+        self.disputed = np.concatenate([self.disputed, np.zeros(len(boxes), dtype=bool)])
+        if self.labels is not None:
+            self.labels.extend(labels)
+
+
+class PageMatch:
+    # How one source's labels of a page were merged. rows index the merged page as it was before,
+    # cols and added index the source's labels.
+    def __init__(self, rows, cols, ious):
+        self.rows = rows  # Matched pairs
+        self.cols = cols
+        self.ious = ious
+        self.same_label = np.zeros(0, dtype=bool)
+        self.added = np.zeros(0, dtype=np.intp)  # Labels added to the page, in order
+        self.overlap = np.zeros(0, dtype=bool)  # Which added labels are low-overlap conflicts
+        self.overlap_rows = np.zeros(0, dtype=np.intp)  # The merged box each of them overlaps most
+        self.overlap_ious = np.zeros(0)
+
+
+class AnnotationMerger:
+    def __init__(self, sources, match_iou=MATCH_IOU, conflict_iou=CONFLICT_IOU, keep_labels=False):
+        self.sources = list(sources)  # Names, merge() takes the index of one
+        self.match_iou = match_iou
+        self.conflict_iou = conflict_iou
+        self.keep_labels = keep_labels
+        self.pages = {}  # Page number -> MergedPage, in the order pages were first seen
+        self.stats = [{"boxes": 0, "matched": 0, "label_disagreements": 0, "overlap_conflicts": 0, "new": 0}
+                      for _ in self.sources]
+        self.conflicts = []
+        self.iou_total = 0.0
+        self.matched_pairs = 0
+
+    def add_page(self, page_number, source, positions, texts):
+        # Start a page from annotations that are already merged, like the ones open in the tool
+        page = self.pages[page_number] = MergedPage(position_boxes(positions), texts)
+        self.stats[source]["boxes"] += len(page)
+        self.stats[source]["new"] += len(page)
+        return page
+
+    def merge(self, page_number, source, labels):
+        # Fold one source's labels of a page into the merged page and record how they compared
+        if page_number not in self.pages:
+            self.pages[page_number] = MergedPage(labels=[] if self.keep_labels else None)
+        page = self.pages[page_number]
+        boxes = label_boxes(labels)
+        texts = np.asarray([label["text"] for label in labels], dtype=object)
+
+        rows, cols, ious = overlapping_pairs(page.boxes, boxes, self.conflict_iou)
+        strong = ious >= self.match_iou
+        match = PageMatch(*greedy_match(rows[strong], cols[strong], ious[strong]))
+        match.same_label = (page.texts[match.rows] == texts[match.cols]).astype(bool)
+        page.votes[match.rows[match.same_label]] += 1
+        page.disputed[match.rows[~match.same_label]] = True
+
+        # Best overlap of every box with the merged ones, which tells low-overlap conflicts from new boxes
+        best_iou = np.zeros(len(labels))
+        best_row = np.full(len(labels), -1, dtype=np.intp)
+        order = np.lexsort((ious, cols))
+        best = order[np.append(cols[order][1:] != cols[order][:-1], True)] if len(order) else order
+        best_iou[cols[best]] = ious[best]
+        best_row[cols[best]] = rows[best]
+
+        unmatched = np.ones(len(labels), dtype=bool)
+        unmatched[match.cols] = False
+        match.added = np.nonzero(unmatched)[0]
+        match.overlap_rows = best_row[match.added]
+        match.overlap_ious = best_iou[match.added]
+        match.overlap = match.overlap_rows >= 0
+        self.record(page_number, source, page, match, labels, boxes)
+        page.append(boxes[match.added], texts[match.added], [labels[idx] for idx in match.added.tolist()])
+        return match
+
+    def record(self, page_number, source, page, match, labels, boxes):
+        stats = self.stats[source]
+        stats["boxes"] += len(labels)
+        stats["matched"] += int(np.count_nonzero(match.same_label))
+        stats["label_disagreements"] += int(np.count_nonzero(~match.same_label))
+        stats["overlap_conflicts"] += int(np.count_nonzero(match.overlap))
+        stats["new"] += int(np.count_nonzero(~match.overlap))
+        self.iou_total += float(match.ious.sum())
+        self.matched_pairs += len(match.ious)
+
+        disagreements = ~match.same_label
+        for row, col, iou in zip(match.rows[disagreements].tolist(), match.cols[disagreements].tolist(),
+                                 match.ious[disagreements].tolist()):
+            self.conflicts.append(self.conflict(page_number, "label", source, page, row, labels[col], boxes[col], iou))
+        for col, row, iou in zip(match.added[match.overlap].tolist(), match.overlap_rows[match.overlap].tolist(),
+                                 match.overlap_ious[match.overlap].tolist()):
+            self.conflicts.append(self.conflict(page_number, "overlap", source, page, row, labels[col], boxes[col],
+                                                iou))
+
+    def conflict(self, page_number, kind, source, page, row, label, box, iou):
+        # Boxes are [x0, y0, x1, y1] in scene pixels
+        return {"page": page_number, "type": kind, "source": self.sources[source], "iou": round(iou, 3),
+                "text": page.texts[row], "box": page.boxes[row].tolist(),
+                "other_text": label["text"], "other_box": box.tolist()}
+
+    def merged_annotations(self):
+        return {page_number: {"labels": page.labels} for page_number, page in self.pages.items()}
+
+    def report(self):
+        # A box counts as agreed when every source drew it with the same label
+        pages = {}
+        boxes = agreed = 0
+        for page_number, page in self.pages.items():
+            page_agreed = int(np.count_nonzero((page.votes == len(self.sources)) & ~page.disputed))
+            pages[page_number] = {"boxes": len(page), "agreed": page_agreed,
+                                  "disputed": int(np.count_nonzero(page.disputed)),
+                                  "agreement": round(page_agreed / len(page), 4) if len(page) else 1.0}
+            boxes += len(page)
+            agreed += page_agreed
+        return {
+            "sources": [dict(stats, name=name) for name, stats in zip(self.sources, self.stats)],
+            "match_iou": self.match_iou, "conflict_iou": self.conflict_iou,
+            "boxes": boxes, "agreed": agreed, "agreement": round(agreed / boxes, 4) if boxes else 1.0,
+            "mean_iou": round(self.iou_total / self.matched_pairs, 4) if self.matched_pairs else None,
+            "label_disagreements": sum(stats["label_disagreements"] for stats in self.stats),
+            "overlap_conflicts": sum(stats["overlap_conflicts"] for stats in self.stats),
+            "pages": pages,
+            "conflicts": self.conflicts
+        }
+
+
+def merge_annotation_files(paths, match_iou=MATCH_IOU, conflict_iou=CONFLICT_IOU):
+    # The first file wins label disagreements. Returns the AnnotationMerger.
+    merger = AnnotationMerger([os.path.basename(path) for path in paths], match_iou, conflict_iou, keep_labels=True)
+    for source, path in enumerate(paths):
+        with open(path, "r") as json_file:
+            annotations = json.load(json_file)
+        for page_number, data in annotations.items():
+            merger.merge(page_number, source, data["labels"])
+    return merger
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the annotation files several annotators made for the same "
+                                                 "PDF, keeping the boxes they share once and reporting where they "
+                                                 "disagree.")
+    parser.add_argument("output", help="merged annotation JSON to write")
+    parser.add_argument("inputs", nargs="+", help="annotation JSON files; the first one wins label disagreements")
+    parser.add_argument("--report", help="write the agreement report with every conflict to this JSON file")
+    parser.add_argument("--match-iou", type=float, default=MATCH_IOU,
+                        help="overlap at which two boxes mark the same region")
+    parser.add_argument("--conflict-iou", type=float, default=CONFLICT_IOU,
+                        help="smaller overlap still flagged as a conflict")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    merger = merge_annotation_files(args.inputs, args.match_iou, args.conflict_iou)
+    with open(args.output, "w") as json_file:
+        json.dump(merger.merged_annotations(), json_file, indent=4)
+    report = merger.report()
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+    print("Merged {} files into {} boxes in {:.1f}s: {:.1%} agreement, {} label disagreements, "
+          "{} low-overlap conflicts".format(len(args.inputs), report["boxes"], time.perf_counter() - start,
+                                            report["agreement"], report["label_disagreements"],
+                                            report["overlap_conflicts"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
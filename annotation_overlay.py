@@ -0,0 +1,323 @@
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QPointF
+from PyQt5.QtGui import QPolygonF, QPen, QBrush, QFont, QColor
+from PyQt5.QtWidgets import QGraphicsItemGroup, QGraphicsPolygonItem, QGraphicsSimpleTextItem
+
+from spatial_index import GridIndex
+
+OVERLAY_Z = 1  # Above the page pixmap and zoom tiles
+
+# Rough memory cost of a label charged to the shared budget: two graphics items plus index entries
+# once built, a queue entry before that
+BUILT_LABEL_BYTES = 2048
+QUEUED_LABEL_BYTES = 256
+
+
+class OverlayStyle:
+    # Pens, brushes and fonts shared by every overlay item instead of being created per box
+    def __init__(self):
+        self.box_pen = QPen(QColor(255, 0, 0), 3)  # Thicker red border
+        self.box_brush = QBrush(QColor(255, 0, 0, 50))  # Semi-transparent red fill for better visibility
+        self.hover_pen = QPen(QColor(255, 200, 0), 4)
+        self.selection_pen = QPen(QColor(0, 200, 255), 4)
+        self.label_font = QFont("Arial", 13, QFont.Bold)  # Larger, bold font
+        self.label_brush = QBrush(Qt.blue)
+        self.suggestion_pen = QPen(QColor(0, 170, 0), 2, Qt.DashLine)
+        self.suggestion_brush = QBrush(QColor(0, 170, 0, 40))
+        self.suggestion_label_brush = QBrush(QColor(0, 120, 0))
+        self.text_sizes = {}  # Label text -> (width, height) in label_font
+
+    def text_size(self, text, item):
+        size = self.text_sizes.get(text)
+        if size is None:
+            rect = item.boundingRect()
+            size = self.text_sizes[text] = (rect.width(), rect.height())
+        return size
+
+
+def build_label_items(label, parent, style, pen, brush, text_brush):
+    x = label["position"]["x"]
+    y = label["position"]["y"]
+    width = label["position"]["width"]
+    height = label["position"]["height"]
+
+    # Create bounding box
+    bounding_box = QGraphicsPolygonItem(QPolygonF([
+        QPointF(x, y),
+        QPointF(x + width, y),
+        QPointF(x + width, y + height),
+        QPointF(x, y + height)
+    ]), parent)
+    bounding_box.setBrush(brush)
+    bounding_box.setPen(pen)
+
+    # Create text annotation centred in the box
+    label_item = QGraphicsSimpleTextItem(label["text"], parent)
+    label_item.setFont(style.label_font)
+    label_item.setBrush(text_brush)
+    text_width, text_height = style.text_size(label["text"], label_item)
+    label_item.setPos(x + width / 2 - text_width / 2, y + height / 2 - text_height / 2)
+    return bounding_box, label_item
+
+
+class PageOverlay:
+    # Boxes and labels of one page, kept in a single item group so the page can leave and re-enter the scene.
+    # Items are drawn from the page's PageLabels and refer to their labels by uid.
+    def __init__(self, labels, style):
+        self.labels = labels  # PageLabels of the page, None until it has any
+        self.style = style
+        self.group = QGraphicsItemGroup()
+        self.group.setZValue(OVERLAY_Z)
+        self.box_index = GridIndex()  # Built bounding box items by scene position
+        self.box_uids = {}  # Bounding box item -> uid of its label
+        self.boxes = {}  # uid -> bounding box item
+        self.text_items = {}  # Bounding box item -> its text item
+        self.selected = set()  # uids of the selected labels
+        # uids of labels whose items have not been created yet because they were never in view
+        self.unbuilt_index = GridIndex()
+        if labels is not None:
+            self.queue(labels.live())
+
+    def queue(self, records):
+        for uid, (x, y, width, height) in zip(records["uid"].tolist(), records["position"].tolist()):
+            self.unbuilt_index.insert(uid, x, y, width, height)
+
+    def build_visible(self, rect):
+        keys = self.unbuilt_index.overlapping(rect.x(), rect.y(), rect.width(), rect.height())
+        if not keys:
+            return
+        for key in keys:
+            self.unbuilt_index.remove(key)
+        records = self.labels.records(keys)  # Oldest first so stacking follows the label order
+        for uid, label in zip(records["uid"].tolist(), self.labels.store.to_labels(records)):
+            self.build(uid, label)
+
+    def build(self, uid, label):
+        pen = self.style.selection_pen if uid in self.selected else self.style.box_pen
+        bounding_box, label_item = build_label_items(label, self.group, self.style, pen,
+                                                     self.style.box_brush, self.style.label_brush)
+        position = label["position"]
+        self.box_index.insert(bounding_box, position["x"], position["y"], position["width"], position["height"])
+        self.box_uids[bounding_box] = uid
+        self.boxes[uid] = bounding_box
+        self.text_items[bounding_box] = label_item
+        return bounding_box
+
+    def remove_box(self, box):
+        scene = self.group.scene()
+        for item in (box, self.text_items.pop(box, None)):
+            if item is not None:
+                item.setParentItem(None)
+                if scene is not None:
+                    scene.removeItem(item)
+        self.box_index.remove(box)
+        uid = self.box_uids.pop(box, None)
+        self.boxes.pop(uid, None)
+        return uid
+
+    def update_labels(self, labels, uids):
+        # Redraw only the labels an edit touched; they are built again once in view
+        self.labels = labels
+        for uid in uids:
+            box = self.boxes.get(uid)
+            if box is not None:
+                self.remove_box(box)
+            self.unbuilt_index.remove(uid)
+        records = labels.records(uids)
+        self.selected.difference_update(set(uids) - set(records["uid"].tolist()))  # Deleted ones
+        self.queue(records)
+
+    def set_selected(self, uids, selected):
+        for uid in uids:
+            if selected:
+                self.selected.add(uid)
+            else:
+                self.selected.discard(uid)
+            box = self.boxes.get(uid)
+            if box is not None:
+                box.setPen(self.style.selection_pen if selected else self.style.box_pen)
+
+    def pen_for(self, box):
+        return self.style.selection_pen if self.box_uids.get(box) in self.selected else self.style.box_pen
+
+    def estimated_bytes(self):
+        return len(self.box_uids) * BUILT_LABEL_BYTES + len(self.unbuilt_index) * QUEUED_LABEL_BYTES
+
+
+class AnnotationOverlay:
+    # Keeps prebuilt overlays of recently visited pages so flipping back does not rebuild every item.
+    # Pages are keyed by (document, page number) so several open documents can share the cache.
+    def __init__(self, scene, max_pages=8, budget=None):
+        self.scene = scene
+        self.max_pages = max_pages
+        self.budget = budget  # Shared MemoryBudget of the workspace, replaces max_pages when set
+        self.style = OverlayStyle()
+        self.doc_key = None
+        self.pages = OrderedDict()  # (doc_key, page number) -> PageOverlay, least recently used first
+        self.current = None
+        self.current_key = None
+        # The budget may evict from a render thread, graphics items are only dropped on the GUI thread
+        self.evicted = []
+        self.evicted_lock = threading.Lock()
+
+    def set_document(self, doc_key):
+        self.detach()
+        self.doc_key = doc_key
+
+    def detach(self):
+        # Take the current page's group out of the scene, must happen before scene.clear() deletes it
+        if self.current is not None:
+            self.current.set_selected(list(self.current.selected), False)  # A selection ends with the visit
+            self.scene.removeItem(self.current.group)
+            self.current = None
+            self.current_key = None
+
+    def attach(self, page_number, labels):
+        self.drop_evicted()
+        key = (self.doc_key, page_number)
+        page_overlay = self.pages.get(key)
+        if page_overlay is None:
+            page_overlay = self.pages[key] = PageOverlay(labels, self.style)
+            while self.budget is None and len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        self.pages.move_to_end(key)
+        self.scene.addItem(page_overlay.group)
+        self.current = page_overlay
+        self.current_key = key
+        self.charge()
+        return page_overlay
+
+    def invalidate(self, page_number=None):
+        # Drop prebuilt items after the labels of a page (or of every page of the document) changed
+        # behind the overlay's back
+        if page_number is None:
+            keys = [key for key in self.pages if key[0] == self.doc_key]
+        else:
+            keys = [(self.doc_key, page_number)]
+        self.drop(keys)
+
+    def drop_document(self, doc_key):
+        # Free the overlays of a document that was closed
+        self.drop([key for key in self.pages if key[0] == doc_key])
+
+    def drop(self, keys):
+        for key in keys:
+            if key == self.current_key:
+                self.detach()
+            if self.pages.pop(key, None) is not None and self.budget is not None:
+                self.budget.release(self, key)
+
+    def evict(self, key):
+        # Called by the shared budget, possibly from a render thread
+        with self.evicted_lock:
+            self.evicted.append(key)
+
+    def drop_evicted(self):
+        with self.evicted_lock:
+            evicted, self.evicted = self.evicted, []
+        for key in evicted:
+            if key != self.current_key:  # Still on screen, charged again on its next update
+                self.pages.pop(key, None)
+
+    def charge(self):
+        if self.budget is not None and self.current is not None:
+            self.budget.charge(self, self.current_key, self.current.estimated_bytes())
+
+    def update_visible(self, rect):
+        if self.current is not None:
+            built = len(self.current.box_uids)
+            self.current.build_visible(rect)
+            if len(self.current.box_uids) != built:
+                self.charge()
+
+    def update_labels(self, page_number, labels, uids):
+        # Labels of a page were edited; a cached overlay of the page is patched instead of rebuilt
+        key = (self.doc_key, page_number)
+        page_overlay = self.pages.get(key)
+        if page_overlay is not None and labels is not None:
+            page_overlay.update_labels(labels, uids)
+            if key == self.current_key:
+                self.charge()
+
+    def at_point(self, x, y):
+        if self.current is None:
+            return []
+        return self.current.box_index.at_point(x, y)
+
+    def uid_for(self, box):
+        return self.current.box_uids.get(box)
+
+    def selection(self):
+        return sorted(self.current.selected) if self.current is not None else []
+
+    def set_selected(self, uids, selected=True):
+        if self.current is not None:
+            self.current.set_selected(uids, selected)
+
+    def toggle_selected(self, box):
+        uid = self.uid_for(box)
+        if uid is not None:
+            self.current.set_selected([uid], uid not in self.current.selected)
+
+    def clear_selection(self):
+        self.set_selected(self.selection(), False)
+
+    def restore_pen(self, box):
+        # Pen of a box that is no longer hovered
+        box.setPen(self.current.pen_for(box) if self.current is not None else self.style.box_pen)
+
+
+class SuggestionLayer:
+    # Proposed boxes drawn above the annotations until the annotator accepts or rejects each one
+    def __init__(self, scene, style):
+        self.scene = scene
+        self.style = style
+        self.group = None
+        self.index = GridIndex()
+        self.labels = {}  # Suggestion box item -> proposed label record
+        self.text_items = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def show(self, labels):
+        self.clear()
+        self.group = QGraphicsItemGroup()
+        self.group.setZValue(OVERLAY_Z + 1)
+        for label in labels:
+            box, text_item = build_label_items(label, self.group, self.style, self.style.suggestion_pen,
+                                               self.style.suggestion_brush, self.style.suggestion_label_brush)
+            position = label["position"]
+            self.index.insert(box, position["x"], position["y"], position["width"], position["height"])
+            self.labels[box] = label
+            self.text_items[box] = text_item
+        self.scene.addItem(self.group)
+
+    def at_point(self, scene_pos):
+        for box in self.index.at_point(scene_pos.x(), scene_pos.y()):
+            if box.contains(scene_pos):
+                return box
+        return None
+
+    def take(self, box):
+        # Remove one suggestion from the page and hand back its label record
+        for item in (box, self.text_items.pop(box)):
+            item.setParentItem(None)
+            self.scene.removeItem(item)
+        self.index.remove(box)
+        return self.labels.pop(box)
+
+    def take_all(self):
+        labels = list(self.labels.values())
+        self.clear()
+        return labels
+
+    def clear(self):
+        if self.group is not None and self.group.scene() is self.scene:
+            self.scene.removeItem(self.group)
+        self.group = None
+        self.index.clear()
+        self.labels = {}
+        self.text_items = {}
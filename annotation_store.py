@@ -0,0 +1,319 @@
+import math
+from collections import deque
+
+import numpy as np
+
+from coordinates import scene_scale
+
+# Labels are held in one NumPy structured array per page instead of a dict per label: about 80 bytes a
+# box rather than several hundred, so documents with hundreds of thousands of boxes stay small.
+# Every label gets a uid that is unique within the store. Rows are kept in uid order, which is also the
+# order labels were added in, so the rows of a selection are found with a binary search. Deleted rows
+# are only flagged and squeezed out once they make up half of the page.
+#
+# Every change is a PageEdit holding the records of the touched labels before and after it, so undoing a
+# change is applying its reverse. The usual {"labels": [{"position", "text", "pdf_rect"}]} dicts are only
+# built for saving, exporting and the journal. No Qt dependency.
+
+LABEL_DTYPE = np.dtype([
+    ("uid", np.int64),
+    ("position", np.float64, (4,)),  # x, y, width, height in scene pixels
+    ("pdf_rect", np.float64, (4,)),  # x0, y0, x1, y1 in PDF points, NaN while the label has none
+    ("text", np.int32),  # Index into the store's text table
+    ("alive", np.bool_),
+])
+LABEL_KEYS = ("position", "text", "pdf_rect")
+NO_PDF_RECT = (math.nan,) * 4
+COMPACT_MIN_DEAD = 64
+MAX_UNDO = 100  # Commands kept per document
+
+
+def scene_positions_to_pdf_rects(positions, page_rect):
+    # coordinates.scene_position_to_pdf_rect for an (n, 4) array of positions, rounded like sync_label_coordinates
+    scale = scene_scale(page_rect.width, page_rect.height)
+    x0 = positions[:, 0] / scale
+    y0 = positions[:, 1] / scale
+    x1 = (positions[:, 0] + positions[:, 2]) / scale
+    y1 = (positions[:, 1] + positions[:, 3]) / scale
+    return np.round(np.stack([page_rect.x0 + np.minimum(x0, x1), page_rect.y0 + np.minimum(y0, y1),
+                              page_rect.x0 + np.maximum(x0, x1), page_rect.y0 + np.maximum(y0, y1)], axis=1), 2)
+
+
+class PageEdit:
+    __slots__ = ("page_number", "before", "after")
+
+    def __init__(self, page_number, before, after):
+        self.page_number = page_number
+        self.before = before  # Records of the touched labels before the edit, none for labels it adds
+        self.after = after  # Their records after it, none for labels it deletes
+
+    def __len__(self):
+        return max(len(self.before), len(self.after))
+
+    def reversed(self):
+        return PageEdit(self.page_number, self.after, self.before)
+
+    def uids(self):
+        return np.union1d(self.before["uid"], self.after["uid"])
+
+
+class Command:
+    __slots__ = ("description", "edits")
+
+    def __init__(self, description, edits):
+        self.description = description
+        self.edits = edits
+
+
+class PageLabels:
+    def __init__(self, store):
+        self.store = store
+        self.rows = np.zeros(16, LABEL_DTYPE)
+        self.count = 0  # Rows in use, deleted ones included
+        self.dead = 0
+
+    def __len__(self):
+        return self.count - self.dead
+
+    def live(self):
+        rows = self.rows[:self.count]
+        return rows[rows["alive"]]
+
+    def _locate(self, uids):
+        # Row of every uid and whether it is on this page at all (deleted rows included)
+        uids = np.asarray(uids, dtype=np.int64)
+        if self.count == 0:
+            return np.zeros(len(uids), dtype=np.intp), np.zeros(len(uids), dtype=bool)
+        used = self.rows["uid"][:self.count]
+        rows = np.minimum(np.searchsorted(used, uids), self.count - 1)
+        return rows, used[rows] == uids
+
+    def find(self, uids):
+        # Rows of the live labels among uids, in row order
+        rows, present = self._locate(uids)
+        rows = rows[present]
+        return np.sort(rows[self.rows["alive"][rows]])
+
+    def records(self, uids):
+        return self.rows[self.find(uids)]
+
+    def put(self, records):
+        # Write records back by uid: overwrite live rows, revive deleted ones and insert the rest in uid order
+        if not len(records):
+            return
+        rows, present = self._locate(records["uid"])
+        existing = rows[present]
+        self.dead -= int(np.count_nonzero(~self.rows["alive"][existing]))
+        self.rows[existing] = records[present]
+        self.rows["alive"][existing] = True
+        missing = records[~present]
+        if not len(missing):
+            return
+        missing = missing[np.argsort(missing["uid"], kind="stable")]
+        missing["alive"] = True
+        if self.count and missing["uid"][0] < self.rows["uid"][self.count - 1]:
+            # Restoring labels that were squeezed out, rare enough to simply re-sort the page
+            merged = np.concatenate([self.rows[:self.count], missing])
+            merged = merged[np.argsort(merged["uid"], kind="stable")]
+            self.count = 0
+            missing = merged
+        self._append(missing)
+
+    def _append(self, records):
+        needed = self.count + len(records)
+        if needed > len(self.rows):
+            grown = np.zeros(max(needed, 2 * len(self.rows)), LABEL_DTYPE)
+            grown[:self.count] = self.rows[:self.count]
+            self.rows = grown
+        self.rows[self.count:needed] = records
+        self.count = needed
+
+    def remove(self, uids):
+        rows = self.find(uids)
+        self.rows["alive"][rows] = False
+        self.dead += len(rows)
+        if self.dead > COMPACT_MIN_DEAD and self.dead * 2 > self.count:
+            live = self.live()
+            self.rows = np.zeros(max(16, 2 * len(live)), LABEL_DTYPE)
+            self.rows[:len(live)] = live
+            self.count = len(live)
+            self.dead = 0
+
+
+class AnnotationStore:
+    def __init__(self, annotations=None):
+        self.pages = {}  # Page number (str) -> PageLabels, in the order pages were first annotated
+        self.texts = []
+        self.text_ids = {}  # Label text -> index in self.texts
+        self.extras = {}  # uid -> keys of a label dict the store has no column for
+        self.next_uid = 0
+        for page_number, data in (annotations or {}).items():
+            self.add(page_number, data["labels"])
+
+    def __contains__(self, page_number):
+        return page_number in self.pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def get(self, page_number):
+        return self.pages.get(page_number)
+
+    def page(self, page_number):
+        if page_number not in self.pages:
+            self.pages[page_number] = PageLabels(self)
+        return self.pages[page_number]
+
+    def count(self, page_number):
+        return len(self.pages[page_number]) if page_number in self.pages else 0
+
+    def uids(self, page_number):
+        return self.pages[page_number].live()["uid"].tolist() if page_number in self.pages else []
+
+    def records(self, page_number, uids):
+        return self.pages[page_number].records(uids) if page_number in self.pages else np.zeros(0, LABEL_DTYPE)
+
+    def text_id(self, text):
+        if text not in self.text_ids:
+            self.text_ids[text] = len(self.texts)
+            self.texts.append(text)
+        return self.text_ids[text]
+
+    def records_from_labels(self, labels):
+        # New records with fresh uids for label dicts
+        records = np.zeros(len(labels), LABEL_DTYPE)
+        if not labels:
+            return records
+        records["uid"] = np.arange(self.next_uid, self.next_uid + len(labels))
+        self.next_uid += len(labels)
+        records["position"] = [(label["position"]["x"], label["position"]["y"], label["position"]["width"],
+                                label["position"]["height"]) for label in labels]
+        records["pdf_rect"] = [label.get("pdf_rect", NO_PDF_RECT) for label in labels]
+        records["text"] = [self.text_id(label["text"]) for label in labels]
+        records["alive"] = True
+        for uid, label in zip(records["uid"].tolist(), labels):
+            extra = {key: value for key, value in label.items() if key not in LABEL_KEYS}
+            if extra:
+                self.extras[uid] = extra
+        return records
+
+    def to_labels(self, records):
+        # Label dicts as saved by the tool
+        labels = []
+        for uid, position, pdf_rect, text in zip(records["uid"].tolist(), records["position"].tolist(),
+                                                 records["pdf_rect"].tolist(), records["text"].tolist()):
+            x, y, width, height = (int(value) if value.is_integer() else value for value in position)
+            label = {"position": {"x": x, "y": y, "width": width, "height": height}, "text": self.texts[text]}
+            if not math.isnan(pdf_rect[0]):
+                label["pdf_rect"] = pdf_rect
+            if uid in self.extras:
+                label.update(self.extras[uid])
+            labels.append(label)
+        return labels
+
+    def labels(self, page_number):
+        return self.to_labels(self.pages[page_number].live()) if page_number in self.pages else []
+
+    def items(self):
+        # (page number, {"labels": [...]}) like the saved JSON, built one page at a time
+        for page_number, page_labels in self.pages.items():
+            yield page_number, {"labels": self.to_labels(page_labels.live())}
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def snapshot(self):
+        # Independent copy for a worker thread, the arrays are copied and nothing else is shared
+        copy = AnnotationStore()
+        copy.texts = list(self.texts)
+        copy.text_ids = dict(self.text_ids)
+        copy.extras = dict(self.extras)
+        copy.next_uid = self.next_uid
+        for page_number, page_labels in self.pages.items():
+            page_copy = copy.page(page_number)
+            page_copy.rows = page_labels.rows[:page_labels.count].copy()
+            page_copy.count = page_labels.count
+            page_copy.dead = page_labels.dead
+        return copy
+
+    def apply(self, edit):
+        # Turn the touched labels of a page from edit.before into edit.after
+        page_labels = self.page(edit.page_number)
+        page_labels.remove(np.setdiff1d(edit.before["uid"], edit.after["uid"]))
+        page_labels.put(edit.after)
+        return edit
+
+    # The edits below are applied right away and return their PageEdit for the command log
+
+    def add(self, page_number, labels):
+        return self.apply(PageEdit(page_number, np.zeros(0, LABEL_DTYPE), self.records_from_labels(labels)))
+
+    def delete(self, page_number, uids):
+        return self.apply(PageEdit(page_number, self.records(page_number, uids), np.zeros(0, LABEL_DTYPE)))
+
+    def move(self, page_number, uids, dx, dy, page_rect=None):
+        before = self.records(page_number, uids)
+        after = before.copy()
+        after["position"][:, 0] += dx
+        after["position"][:, 1] += dy
+        return self.apply(PageEdit(page_number, before, self.with_pdf_rects(after, page_rect)))
+
+    def resize(self, page_number, uids, dw, dh, page_rect=None):
+        # Grows (or shrinks) every box by dw x dh, never below one pixel; boxes drawn from bottom-right to
+        # top-left keep their negative sizes
+        before = self.records(page_number, uids)
+        after = before.copy()
+        for column, delta in ((2, dw), (3, dh)):
+            sizes = after["position"][:, column]
+            after["position"][:, column] = np.where(sizes < 0, np.minimum(sizes - delta, -1),
+                                                    np.maximum(sizes + delta, 1))
+        return self.apply(PageEdit(page_number, before, self.with_pdf_rects(after, page_rect)))
+
+    def relabel(self, page_number, uids, text):
+        before = self.records(page_number, uids)
+        after = before.copy()
+        after["text"] = self.text_id(text)
+        return self.apply(PageEdit(page_number, before, after))
+
+    @staticmethod
+    def with_pdf_rects(records, page_rect):
+        # pdf_rect follows a changed position, or is dropped until the label is synced when the page is unknown
+        if page_rect is None:
+            records["pdf_rect"] = math.nan
+        elif len(records):
+            records["pdf_rect"] = scene_positions_to_pdf_rects(records["position"], page_rect)
+        return records
+
+
+class CommandLog:
+    # Undo/redo history of one document's store
+    def __init__(self, max_commands=MAX_UNDO):
+        self.undo_stack = deque(maxlen=max_commands)
+        self.redo_stack = []
+
+    def push(self, description, edits):
+        edits = [edit for edit in edits if len(edit)]
+        if not edits:
+            return None
+        command = Command(description, edits)
+        self.undo_stack.append(command)
+        self.redo_stack = []
+        return command
+
+    def undo(self, store):
+        # Applies the reverse of the last command and returns the applied edits, or [] with nothing to undo
+        if not self.undo_stack:
+            return []
+        command = self.undo_stack.pop()
+        self.redo_stack.append(command)
+        return [store.apply(edit.reversed()) for edit in reversed(command.edits)]
+
+    def redo(self, store):
+        if not self.redo_stack:
+            return []
+        command = self.redo_stack.pop()
+        self.undo_stack.append(command)
+        return [store.apply(edit) for edit in command.edits]
@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz  # PyMuPDF
+
+from coordinates import label_pdf_rect
+
+# Headless counterpart of the GUI: crops every labeled region of an annotation template out of a
+# directory of PDFs. Nothing here imports Qt, so it runs on servers without a display.
+
+
+def safe_name(text):
+    # Labels are free text typed by annotators, keep them usable as file names
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", text).strip("_") or "label"
+
+
+def unique_names(stems):
+    # PDFs with the same name in different folders would otherwise write over each other's output, the
+    # repeated names get _<n> (the input's position) appended
+    return [stem if stems.count(stem) == 1 else "{}_{}".format(stem, idx) for idx, stem in enumerate(stems, 1)]
+
+
+def pdf_names(pdf_paths):
+    return unique_names([os.path.splitext(os.path.basename(pdf_path))[0] for pdf_path in pdf_paths])
+
+
+def load_template(template_path, template_page=None):
+    with open(template_path, "r") as json_file:
+        annotations = json.load(json_file)
+
+    if template_page is not None:
+        # One page layout applied to every page
+        if str(template_page) not in annotations:
+            raise ValueError("template page {} is not in {} (it has pages {})".format(
+                template_page, template_path, ", ".join(sorted(annotations)) or "none"))
+        return {None: annotations[str(template_page)]["labels"]}
+    return {int(page_number): data["labels"] for page_number, data in annotations.items()}
+
+
+def labels_for_page(template, page_number):
+    if None in template:
+        return template[None]
+    return template.get(page_number + 1, [])
+
+
+def crop_pages(pdf_path, name, first_page, last_page, template, output_dir, dpi, image_format):
+    # Worker: crop every template region of pages [first_page, last_page) of one PDF into output_dir/name
+    document = fitz.open(pdf_path)
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    pdf_dir = os.path.join(output_dir, name)
+    regions = 0
+
+    for page_number in range(first_page, last_page):
+        labels = labels_for_page(template, page_number)
+        if not labels:
+            continue
+        page = document.load_page(page_number)
+        page_dir = os.path.join(pdf_dir, "page_{}".format(page_number + 1))
+        os.makedirs(page_dir, exist_ok=True)
+
+        used_names = set()
+        for label in labels:
+            clip = fitz.Rect(label_pdf_rect(label, page.rect)) & page.rect
+            if clip.is_empty:
+                continue
+
+            # Keep duplicate labels on the same page apart
+            file_name = safe_name(label["text"])
+            suffix = 1
+            while file_name in used_names:
+                suffix += 1
+                file_name = "{}_{}".format(safe_name(label["text"]), suffix)
+            used_names.add(file_name)
+
+            pix = page.get_pixmap(matrix=matrix, clip=clip)
+            if pix.width == 0 or pix.height == 0:
+                continue
+            pix.save(os.path.join(page_dir, "{}.{}".format(file_name, image_format)))
+            regions += 1
+
+    document.close()
+    return last_page - first_page, regions
+
+
+def find_pdfs(input_dir):
+    pdfs = []
+    for root, _, files in os.walk(input_dir):
+        for file_name in files:
+            if file_name.lower().endswith(".pdf"):
+                pdfs.append(os.path.join(root, file_name))
+    return sorted(pdfs)
+
+
+def page_chunks(pdf_paths, chunk_size, failed):
+    # Split big PDFs into (pdf_path, output folder name, first, last) page ranges so one long document does
+    # not keep a single worker busy. PDFs that cannot be opened are skipped and recorded in failed (path -> errors).
+    for pdf_path, name in zip(pdf_paths, pdf_names(pdf_paths)):
+        try:
+            with fitz.open(pdf_path) as document:
+                page_count = len(document)
+        except Exception as error:
+            failed[pdf_path] = [str(error) or type(error).__name__]
+            continue
+        for first_page in range(0, page_count, chunk_size):
+            yield pdf_path, name, first_page, min(first_page + chunk_size, page_count)
+
+
+def run_batch(template, pdf_paths, output_dir, dpi=200, image_format="png", workers=None, chunk_size=25,
+              report=None):
+    # A PDF or page range that fails is recorded and the rest of the batch carries on. Returns
+    # (pages, regions, seconds, failed) where failed maps each PDF that failed to its errors.
+    failed = {}
+    chunks = list(page_chunks(pdf_paths, chunk_size, failed))
+    total_pages = sum(last - first for _, _, first, last in chunks)
+    pages_done = 0
+    regions_done = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(crop_pages, pdf_path, name, first, last, template, output_dir, dpi,
+                                   image_format): (pdf_path, first, last)
+                   for pdf_path, name, first, last in chunks}
+        for future in as_completed(futures):
+            try:
+                pages, regions = future.result()
+            except Exception as error:
+                pdf_path, first, last = futures[future]
+                message = "pages {}-{}: {}".format(first + 1, last, str(error) or type(error).__name__)
+                failed.setdefault(pdf_path, []).append(message)
+                continue
+            pages_done += pages
+            regions_done += regions
+            if report:
+                elapsed = time.perf_counter() - start
+                report(pages_done, total_pages, regions_done, elapsed)
+
+    return pages_done, regions_done, time.perf_counter() - start, failed
+
+
+def print_progress(pages_done, total_pages, regions_done, elapsed):
+    rate = pages_done / elapsed if elapsed > 0 else 0.0
+    print("\r{}/{} pages, {} regions, {:.1f} pages/s".format(pages_done, total_pages, regions_done, rate),
+          end="", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crop the labeled regions of an annotation template "
+                                                 "from every page of a directory of PDFs.")
+    parser.add_argument("template", help="annotation JSON saved by the MarkIT Annotation Tool")
+    parser.add_argument("input_dir", help="directory searched recursively for PDF files")
+    parser.add_argument("output_dir", help="directory the crops are written to")
+    parser.add_argument("--template-page", type=int,
+                        help="apply the labels of this template page to every page "
+                             "(default: match template pages by page number)")
+    parser.add_argument("--dpi", type=int, default=200, help="resolution of the exported crops")
+    parser.add_argument("--format", dest="image_format", default="png", choices=["png", "jpg"],
+                        help="image format of the exported crops")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=25, help="pages handed to a worker at a time")
+    args = parser.parse_args(argv)
+
+    try:
+        template = load_template(args.template, args.template_page)
+    except ValueError as error:
+        parser.error(str(error))
+    pdf_paths = find_pdfs(args.input_dir)
+    if not pdf_paths:
+        parser.error("no PDF files found in {}".format(args.input_dir))
+
+    pages, regions, elapsed, failed = run_batch(template, pdf_paths, args.output_dir, dpi=args.dpi,
+                                                image_format=args.image_format, workers=args.workers,
+                                                chunk_size=args.chunk_size, report=print_progress)
+    rate = pages / elapsed if elapsed > 0 else 0.0
+    print("\nExported {} regions from {} pages of {} PDFs in {:.1f}s ({:.1f} pages/s)".format(
+        regions, pages, len(pdf_paths), elapsed, rate), file=sys.stderr)
+    if failed:
+        print("{} of {} PDFs failed:".format(len(failed), len(pdf_paths)), file=sys.stderr)
+        for pdf_path, errors in sorted(failed.items()):
+            print("  {}: {}".format(pdf_path, "; ".join(errors)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
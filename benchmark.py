@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+# Runs without a display; must be set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import fitz  # PyMuPDF
+from PyQt5.QtCore import QPointF, QT_VERSION_STR
+from PyQt5.QtWidgets import QApplication
+
+from Answer_Location_Annotator import AnnotationApp
+from annotation_merge import merge_annotation_files
+from annotation_store import AnnotationStore
+from coordinates import SCENE_WIDTH, SCENE_HEIGHT
+from disk_cache import DiskCache, file_hash
+from render_cache import RENDER_ZOOM, render_page_image, bitmap_name, image_bitmap_chunks
+
+# Benchmarks the hot paths of the annotation tool against generated PDFs and annotation sets:
+# page flips (cold, from the disk cache and prefetched), overlay draws, hit-tests, deletes, bulk edits with
+# their undo, JSON round-trips and merging annotators' files.
+#
+#   python benchmark.py --pages 50 --labels 300 --output bench.json
+
+
+def make_pdf(path, pages, seed):
+    # Pages laid out like an answer sheet: a grid of labeled answer boxes plus pen-stroke noise
+    rng = random.Random(seed)
+    document = fitz.open()
+    for page_index in range(pages):
+        page = document.new_page(width=595, height=842)
+        page.insert_text((72, 60), "Synthetic exam page {}".format(page_index + 1), fontsize=16)
+        for row in range(20):
+            for col in range(4):
+                rect = fitz.Rect(60 + col * 125, 90 + row * 36, 60 + col * 125 + 110, 90 + row * 36 + 28)
+                page.draw_rect(rect, color=(0, 0, 0), width=0.8)
+                page.insert_text((rect.x0 + 6, rect.y0 + 18), "{}{}".format(row + 1, "ABCD"[col]), fontsize=10)
+        # Noise so the page does not compress or render like a blank page
+        for _ in range(200):
+            x, y = rng.uniform(0, 595), rng.uniform(0, 842)
+            page.draw_line((x, y), (x + rng.uniform(-8, 8), y + rng.uniform(-8, 8)), color=(0.3, 0.3, 0.3))
+    document.save(path)
+    document.close()
+
+
+def make_annotations(pages, labels_per_page, seed):
+    rng = random.Random(seed)
+    annotations = {}
+    for page_number in range(1, pages + 1):
+        labels = []
+        for idx in range(labels_per_page):
+            width, height = rng.randint(60, 300), rng.randint(20, 60)
+            labels.append({
+                "position": {"x": rng.randint(0, SCENE_WIDTH - width), "y": rng.randint(0, SCENE_HEIGHT - height),
+                             "width": width, "height": height},
+                "text": "{}{}".format(idx // 4 + 1, "ABCD"[idx % 4])
+            })
+        annotations[str(page_number)] = {"labels": labels}
+    return annotations
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1]
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def wait_for_prefetch(app, window):
+    # Stand-in for the time an annotator spends on a page before flipping
+    for future in list(window.render_cache.pending.values()):
+        try:
+            future.result()
+        except Exception:
+            pass
+    app.processEvents()
+
+
+def fill_disk_cache(disk_cache, pdf_path, document):
+    # Every page on disk, as a previous session would have left it
+    doc_hash = file_hash(pdf_path)
+    for page_number in range(len(document)):
+        image = render_page_image(document, page_number, RENDER_ZOOM)
+        disk_cache.put(doc_hash, bitmap_name(page_number, RENDER_ZOOM), *image_bitmap_chunks(image))
+
+
+def bench_page_flips(app, window, flips, prefetched):
+    # Without prefetching, every flip misses the in-memory cache (and the disk cache when it is disabled)
+    samples = []
+    window.current_page = 0
+    window.load_page()
+    for _ in range(flips):
+        if window.current_page >= len(window.pdf_document) - 1:
+            window.current_page = -1
+        if not prefetched:
+            window.clear_hover()
+            window.render_cache.clear()
+            window.overlay.invalidate()
+        else:
+            wait_for_prefetch(app, window)
+        samples.append(timed(window.next_page))
+    return samples
+
+
+def bench_overlay_draws(window, iterations):
+    samples = []
+    for _ in range(iterations):
+        window.clear_hover()
+        window.overlay.invalidate()
+        samples.append(timed(window.draw_existing_annotations))
+    return samples
+
+
+def bench_hit_tests(window, iterations, rng):
+    samples = []
+    for _ in range(iterations):
+        point = QPointF(rng.uniform(0, SCENE_WIDTH), rng.uniform(0, SCENE_HEIGHT))
+        samples.append(timed(window.update_hover, point))
+    return samples
+
+
+def bench_deletes(window, iterations, rng):
+    # Right-click deletes on boxes of the current page, through the same window-to-scene mapping as a real click
+    samples = []
+    page_number = str(window.current_page + 1)
+    view = window.graphics_view
+    for _ in range(iterations):
+        labels = window.annotations.labels(page_number)
+        if not labels:
+            break
+        position = rng.choice(labels)["position"]
+        view.centerOn(position["x"] + position["width"] / 2, position["y"] + position["height"] / 2)
+        window.update_overlay()
+        viewport_pos = view.mapFromScene(QPointF(position["x"] + position["width"] / 2,
+                                                 position["y"] + position["height"] / 2))
+        samples.append(timed(window.delete_bounding_box, view.viewport().mapTo(window, viewport_pos)))
+    return samples
+
+
+def bench_bulk_edits(window, iterations):
+    # Move every label of the current page as one command, then undo it
+    move_samples, undo_samples = [], []
+    window.select_all()
+    for _ in range(iterations):
+        move_samples.append(timed(window.move_selection, 1, 0))
+        undo_samples.append(timed(window.undo))
+    window.overlay.clear_selection()
+    return move_samples, undo_samples
+
+
+def bench_json_round_trips(window, iterations, directory):
+    save_samples, load_samples = [], []
+    file_name = os.path.join(directory, "round_trip.json")
+    for _ in range(iterations):
+        save_samples.append(timed(window.save_annotations_file, file_name))
+        saved = window.annotations
+        window.annotations = AnnotationStore()
+        if window.journal is not None:
+            # Loading would otherwise append every label to the journal again
+            window.journal.close()
+            window.journal = None
+        window.clear_hover()
+        window.overlay.invalidate()
+        load_samples.append(timed(window.load_annotations_file, file_name))
+        window.annotations = saved
+    return save_samples, load_samples
+
+
+def bench_merges(annotations, iterations, directory, rng):
+    # Two annotators over the same document: the second one's boxes are shifted by a few pixels
+    first = os.path.join(directory, "annotator_1.json")
+    second = os.path.join(directory, "annotator_2.json")
+    with open(first, "w") as json_file:
+        json.dump(annotations, json_file)
+    for data in annotations.values():
+        for label in data["labels"]:
+            label["position"]["x"] += rng.randint(-3, 3)
+            label["position"]["y"] += rng.randint(-3, 3)
+    with open(second, "w") as json_file:
+        json.dump(annotations, json_file)
+    return [timed(merge_annotation_files, [first, second]) for _ in range(iterations)]
+
+
+def run(args):
+    app = QApplication.instance() or QApplication([])
+    rng = random.Random(args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = os.path.join(directory, "synthetic.pdf")
+        make_pdf(pdf_path, args.pages, args.seed)
+
+        window = AnnotationApp()
+        window.resize(1200, 900)
+        window.show()
+        app.processEvents()
+        window.open_pdf(pdf_path)
+        window.annotations = AnnotationStore(make_annotations(args.pages, args.labels, args.seed))
+        window.overlay.invalidate()
+        window.load_page()
+
+        disk_cache = DiskCache(os.path.join(directory, "pages"), 2 * 1024 ** 3)
+        window.render_cache.disk_cache = None
+        results["page_flip_cold"] = percentiles(bench_page_flips(app, window, args.flips, prefetched=False))
+        fill_disk_cache(disk_cache, pdf_path, window.pdf_document)
+        window.render_cache.disk_cache = disk_cache
+        results["page_flip_disk"] = percentiles(bench_page_flips(app, window, args.flips, prefetched=False))
+        results["page_flip_prefetched"] = percentiles(bench_page_flips(app, window, args.flips, prefetched=True))
+        results["overlay_draw"] = percentiles(bench_overlay_draws(window, args.iterations))
+        results["hit_test"] = percentiles(bench_hit_tests(window, args.iterations * 10, rng))
+        results["delete"] = percentiles(bench_deletes(window, min(args.iterations, args.labels), rng))
+        move_samples, undo_samples = bench_bulk_edits(window, args.iterations)
+        results["bulk_move"] = percentiles(move_samples)
+        results["undo"] = percentiles(undo_samples)
+        save_samples, load_samples = bench_json_round_trips(window, args.round_trips, directory)
+        results["json_save"] = percentiles(save_samples)
+        results["json_load"] = percentiles(load_samples)
+        results["merge"] = percentiles(bench_merges(make_annotations(args.pages, args.labels, args.seed),
+                                                    args.round_trips, directory, rng))
+
+        window.close()
+
+    return {
+        "parameters": {"pages": args.pages, "labels_per_page": args.labels, "flips": args.flips,
+                       "iterations": args.iterations, "round_trips": args.round_trips, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "pymupdf": fitz.VersionBind, "qt": QT_VERSION_STR},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results
+    }
+
+
+def print_report(report):
+    print("{:<22}{:>8}{:>10}{:>10}{:>10}{:>10}".format("benchmark", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name, stats in report["results"].items():
+        print("{:<22}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            name, stats["count"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["max_ms"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark rendering, navigation and annotation I/O hot paths.")
+    parser.add_argument("--pages", type=int, default=30, help="pages in the synthetic PDF")
+    parser.add_argument("--labels", type=int, default=300, help="labels per page")
+    parser.add_argument("--flips", type=int, default=40, help="page flips per navigation benchmark")
+    parser.add_argument("--iterations", type=int, default=30, help="samples for overlay draws and deletes")
+    parser.add_argument("--round-trips", type=int, default=5, help="JSON save/load round trips and merges")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
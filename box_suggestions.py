@@ -0,0 +1,211 @@
+import re
+import string
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from coordinates import scene_scale
+from spatial_index import GridIndex
+
+# Proposes answer regions for a page so annotators only accept or reject them. Candidates come from
+# the PDF layout (drawn rectangles and answer option text blocks) or, for scanned pages without
+# either, from connected components of ink in a low resolution render. Positions are in scene
+# coordinates, the same as stored annotations. No Qt dependency.
+
+# Size limits for a candidate answer region, in scene pixels
+MIN_WIDTH = 40
+MIN_HEIGHT = 15
+MAX_HEIGHT = 160
+MAX_WIDTH_FRACTION = 0.9
+
+OPTION_MARKER = re.compile(r"^\s*\(?([A-Da-d])[\).:]\s")
+QUESTION_NUMBER = re.compile(r"^(\d+)")
+
+# Scanned page analysis
+SCAN_SCALE = 0.5  # Render at half the scene resolution
+INK_THRESHOLD = 160  # Gray values below this count as ink
+CELL = 4  # Pixels per cell of the coarse ink grid
+GAP_CELLS_X = 2  # Ink is grown this many cells sideways so letters and words merge into one region
+GAP_CELLS_Y = 1
+
+
+def plausible(rect, scene_width):
+    width, height = rect[2] - rect[0], rect[3] - rect[1]
+    return (MIN_WIDTH <= width <= scene_width * MAX_WIDTH_FRACTION and
+            MIN_HEIGHT <= height <= MAX_HEIGHT)
+
+
+def layout_candidates(page, scale):
+    # Drawn rectangles, then text blocks that start with an answer option marker such as "A)" or "(b)"
+    def to_scene(rect):
+        x0, y0 = page.rect.x0, page.rect.y0
+        return (rect.x0 - x0) * scale, (rect.y0 - y0) * scale, (rect.x1 - x0) * scale, (rect.y1 - y0) * scale
+
+    rects = []
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "re":
+                rects.append(to_scene(fitz.Rect(item[1])))
+    for block in page.get_text("blocks"):
+        if OPTION_MARKER.match(block[4]):
+            rects.append(to_scene(fitz.Rect(block[:4])))
+    return rects
+
+
+def ink_components(page, scale):
+    # Connected components of ink on a coarse grid of a grayscale render, for scanned pages
+    render_scale = scale * SCAN_SCALE
+    pix = page.get_pixmap(matrix=fitz.Matrix(render_scale, render_scale), colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+    # Any ink inside a CELL x CELL block marks the cell
+    rows, cols = pix.height // CELL, pix.width // CELL
+    ink = (gray[:rows * CELL, :cols * CELL] < INK_THRESHOLD).reshape(rows, CELL, cols, CELL).any(axis=(1, 3))
+
+    # Close small gaps between glyphs so one answer option becomes one component
+    grown = ink.copy()
+    for shift in range(1, GAP_CELLS_X + 1):
+        grown[:, shift:] |= ink[:, :-shift]
+        grown[:, :-shift] |= ink[:, shift:]
+    closed = grown.copy()
+    for shift in range(1, GAP_CELLS_Y + 1):
+        closed[shift:, :] |= grown[:-shift, :]
+        closed[:-shift, :] |= grown[shift:, :]
+
+    cell_size = CELL / SCAN_SCALE  # Scene pixels per cell
+    rects = []
+    for top, left, bottom, right in label_boxes(closed):
+        # Undo the growth from gap closing
+        left, right = min(left + GAP_CELLS_X, right), max(right - GAP_CELLS_X, left)
+        top, bottom = min(top + GAP_CELLS_Y, bottom), max(bottom - GAP_CELLS_Y, top)
+        rects.append((left * cell_size, top * cell_size, (right + 1) * cell_size, (bottom + 1) * cell_size))
+    return rects
+
+
+def label_boxes(mask):
+    # Bounding boxes (top, left, bottom, right; inclusive) of the 4-connected components of a boolean
+    # mask, in row-major order of their first cell. Works on horizontal runs of cells instead of single
+    # cells: runs on neighbouring rows that share a column are joined with a vectorized union-find.
+    rows, cols = mask.shape
+    padded = np.zeros((rows, cols + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(steps == 1)
+    run_ends = np.nonzero(steps == -1)[1]  # Exclusive
+    if not len(run_rows):
+        return []
+
+    # Runs are sorted by row then column, so the runs of the row above that overlap a run [start, end) are
+    # one contiguous range: those ending after start and starting before end
+    width = cols + 1
+    start_keys = run_rows * width + run_starts
+    end_keys = run_rows * width + run_ends
+    above = (run_rows - 1) * width
+    first = np.searchsorted(end_keys, above + run_starts, side="right")
+    last = np.searchsorted(start_keys, above + run_ends, side="left")
+    counts = np.maximum(last - first, 0)
+    below = np.repeat(np.arange(len(run_rows)), counts)
+    upper = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Every run takes the smallest label of the runs it touches, with pointer jumping, until nothing changes
+    labels = np.arange(len(run_rows))
+    while True:
+        joined = np.minimum(labels[below], labels[upper])
+        updated = labels.copy()
+        np.minimum.at(updated, below, joined)
+        np.minimum.at(updated, upper, joined)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+
+    # Each component's label is its first run, so sorting by label keeps the row-major order
+    order = np.argsort(labels, kind="stable")
+    groups = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    return list(zip(np.minimum.reduceat(run_rows[order], groups).tolist(),
+                    np.minimum.reduceat(run_starts[order], groups).tolist(),
+                    np.maximum.reduceat(run_rows[order], groups).tolist(),
+                    (np.maximum.reduceat(run_ends[order], groups) - 1).tolist()))
+
+
+def drop_overlapping(rects, existing, min_overlap=0.5):
+    # Remove candidates mostly covered by an existing label or by a larger candidate already kept
+    index = GridIndex()
+    for idx, label in enumerate(existing):
+        position = label["position"]
+        index.insert(("label", idx), position["x"], position["y"], position["width"], position["height"])
+
+    kept = []
+    for rect in sorted(rects, key=lambda r: (r[2] - r[0]) * (r[3] - r[1]), reverse=True):
+        area = (rect[2] - rect[0]) * (rect[3] - rect[1])
+        covered = False
+        for key in index.overlapping(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1]):
+            other = index.rect(key)
+            overlap_width = min(rect[2], other[2]) - max(rect[0], other[0])
+            overlap_height = min(rect[3], other[3]) - max(rect[1], other[1])
+            if overlap_width * overlap_height >= min_overlap * area:
+                covered = True
+                break
+        if not covered:
+            index.insert(("candidate", len(kept)), rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1])
+            kept.append(rect)
+    return kept
+
+
+def number_regions(rects, start_question):
+    # Group regions into question bands separated by vertical gaps, then letter each band's options
+    # column by column (A and B down the left column, C and D down the right, as on our answer sheets)
+    if not rects:
+        return []
+    median_height = float(np.median([r[3] - r[1] for r in rects]))
+    median_width = float(np.median([r[2] - r[0] for r in rects]))
+
+    bands = []
+    for rect in sorted(rects, key=lambda r: r[1]):
+        if bands and rect[1] <= bands[-1]["bottom"] + median_height * 0.25:
+            bands[-1]["rects"].append(rect)
+            bands[-1]["bottom"] = max(bands[-1]["bottom"], rect[3])
+        else:
+            bands.append({"rects": [rect], "bottom": rect[3]})
+
+    labels = []
+    for question, band in enumerate(bands, start=start_question):
+        columns = []
+        for rect in sorted(band["rects"], key=lambda r: r[0]):
+            if columns and rect[0] - columns[-1][0][0] < median_width * 0.5:
+                columns[-1].append(rect)
+            else:
+                columns.append([rect])
+        ordered = [rect for column in columns for rect in sorted(column, key=lambda r: r[1])]
+        for option, rect in enumerate(ordered):
+            letter = string.ascii_uppercase[option] if option < 26 else str(option + 1)
+            labels.append({
+                "position": {"x": int(rect[0]), "y": int(rect[1]),
+                             "width": int(rect[2] - rect[0]), "height": int(rect[3] - rect[1])},
+                "text": "{}{}".format(question, letter)
+            })
+    return labels
+
+
+def next_question_number(annotations, page_number):
+    # One past the highest question number labeled on this or any earlier page
+    highest = 0
+    for number, data in annotations.items():
+        if int(number) > page_number:
+            continue
+        for label in data["labels"]:
+            match = QUESTION_NUMBER.match(label["text"])
+            if match:
+                highest = max(highest, int(match.group(1)))
+    return highest + 1
+
+
+def suggest_regions(page, existing=(), start_question=1):
+    scale = scene_scale(page.rect.width, page.rect.height)
+    scene_width = page.rect.width * scale
+
+    rects = [r for r in layout_candidates(page, scale) if plausible(r, scene_width)]
+    if not rects:
+        # Scanned page: no usable text or vector layout, look at the ink instead
+        rects = [r for r in ink_components(page, scale) if plausible(r, scene_width)]
+    return number_regions(drop_overlapping(rects, existing), start_question)
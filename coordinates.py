@@ -0,0 +1,53 @@
+# Annotation positions are kept in two coordinate systems:
+#   "position": the page scene built by AnnotationApp.load_page, in which the page is rendered and then
+#               fitted into a SCENE_WIDTH x SCENE_HEIGHT box keeping its aspect ratio (integer pixels)
+#   "pdf_rect": [x0, y0, x1, y1] in PDF points, independent of any rendering, usable directly as
+#               the clip of page.get_pixmap(clip=...) at any DPI
+# When a label has both, "pdf_rect" is the reference and "position" is derived from it.
+# This module has no Qt dependency so headless tools can share the conversion.
+
+SCENE_WIDTH = 1440
+SCENE_HEIGHT = 2160
+
+
+def scene_scale(page_width, page_height):
+    # Scene pixels per PDF point for a page of the given size
+    return min(SCENE_WIDTH / page_width, SCENE_HEIGHT / page_height)
+
+
+def scene_position_to_pdf_rect(position, page_rect):
+    # position is a stored {"x", "y", "width", "height"} dict, page_rect a fitz.Rect (or any x0/y0/width/height)
+    scale = scene_scale(page_rect.width, page_rect.height)
+    x0 = position["x"] / scale
+    y0 = position["y"] / scale
+    x1 = (position["x"] + position["width"]) / scale
+    y1 = (position["y"] + position["height"]) / scale
+    return (page_rect.x0 + min(x0, x1), page_rect.y0 + min(y0, y1),
+            page_rect.x0 + max(x0, x1), page_rect.y0 + max(y0, y1))
+
+
+def pdf_rect_to_scene_position(pdf_rect, page_rect):
+    scale = scene_scale(page_rect.width, page_rect.height)
+    x0, y0, x1, y1 = pdf_rect
+    return {
+        "x": int(round((x0 - page_rect.x0) * scale)),
+        "y": int(round((y0 - page_rect.y0) * scale)),
+        "width": int(round((x1 - x0) * scale)),
+        "height": int(round((y1 - y0) * scale))
+    }
+
+
+def label_pdf_rect(label, page_rect):
+    # The label's rect in PDF points, converted from its scene position for files saved without one
+    if "pdf_rect" in label:
+        return tuple(label["pdf_rect"])
+    return scene_position_to_pdf_rect(label["position"], page_rect)
+
+
+def sync_label_coordinates(label, page_rect):
+    # Fill in whichever of "position" / "pdf_rect" is missing, re-deriving "position" from "pdf_rect"
+    if "pdf_rect" in label:
+        label["position"] = pdf_rect_to_scene_position(label["pdf_rect"], page_rect)
+    else:
+        label["pdf_rect"] = [round(value, 2) for value in scene_position_to_pdf_rect(label["position"], page_rect)]
+    return label
@@ -0,0 +1,274 @@
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import fitz  # PyMuPDF
+
+from batch_export import safe_name, unique_names, print_progress
+from coordinates import label_pdf_rect
+
+# Turns annotated PDFs into a training dataset. Only the clip of each label is rendered, page chunks
+# are exported in parallel and every chunk streams its crops into its own tar shard:
+#
+#   <output>/shards/shard-00000.tar   crops, <pdf>/page_<n>/<idx>_<label>.<ext>
+#   <output>/manifest.jsonl           one record per crop: shard, member, pdf, page, label, class, boxes
+#   <output>/labels/<pdf>_page_<n>.txt  YOLO boxes of each page ("class cx cy w h", normalized)
+#   <output>/classes.txt              YOLO class names, one per line
+#   <output>/annotations.coco.json    COCO detection file with one image per annotated page
+#
+# The page images the COCO/YOLO boxes refer to are only rendered with --with-pages, as
+# pages/<pdf>_page_<n>.<ext> inside the shards. <pdf> is the PDF's file name without extension, followed by
+# _<n> (its position among the inputs) when several inputs share a name. A cancelled export leaves out
+# classes.txt and the COCO file and writes an INCOMPLETE marker instead, so does one where a chunk failed.
+# No Qt dependency.
+
+INCOMPLETE_MARKER = "INCOMPLETE"
+
+
+def load_annotations(annotations_path):
+    with open(annotations_path, "r") as json_file:
+        return json.load(json_file)
+
+
+def annotated_pages(annotations):
+    # [(page index, labels)] of the pages that have labels, in page order
+    return sorted((int(page_number) - 1, data["labels"])
+                  for page_number, data in annotations.items() if data["labels"])
+
+
+def document_names(documents):
+    # Name of every input in file names and COCO keys, made unique the way batch_export names its folders
+    return unique_names([safe_name(os.path.splitext(os.path.basename(pdf_path))[0]) for pdf_path, _ in documents])
+
+
+def export_chunk(pdf_path, name, pages, shard_path, dpi, image_format, with_pages):
+    # Worker: render the labels of some pages of one PDF into a single tar shard
+    document = fitz.open(pdf_path)
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    records = []
+    page_sizes = {}
+
+    try:
+        with tarfile.open(shard_path + ".tmp", "w") as shard:
+            def add_member(member_name, data):
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                shard.addfile(info, io.BytesIO(data))
+
+            for page_index, labels in pages:
+                page = document.load_page(page_index)
+                page_rect = page.rect
+                page_sizes[page_index] = (page_rect.width, page_rect.height)
+                # Interpret the page once and render every crop from the display list
+                display_list = page.get_displaylist()
+                if with_pages:
+                    pix = display_list.get_pixmap(matrix=matrix)
+                    add_member("pages/{}_page_{}.{}".format(name, page_index + 1, image_format),
+                               pix.tobytes(image_format))
+
+                for idx, label in enumerate(labels):
+                    pdf_rect = label_pdf_rect(label, page_rect)
+                    clip = fitz.Rect(pdf_rect) & page_rect
+                    if clip.is_empty:
+                        continue
+                    pix = display_list.get_pixmap(matrix=matrix, clip=clip)
+                    if pix.width == 0 or pix.height == 0:
+                        continue
+                    member = "{}/page_{}/{:04d}_{}.{}".format(name, page_index + 1, idx, safe_name(label["text"]),
+                                                              image_format)
+                    add_member(member, pix.tobytes(image_format))
+                    records.append({
+                        "shard": os.path.basename(shard_path), "member": member,
+                        "pdf": os.path.basename(pdf_path), "document": name, "page": page_index + 1,
+                        "label": label["text"],
+                        # Relative to the page origin, so they match the rendered page image
+                        "pdf_rect": [round(clip.x0 - page_rect.x0, 2), round(clip.y0 - page_rect.y0, 2),
+                                     round(clip.x1 - page_rect.x0, 2), round(clip.y1 - page_rect.y0, 2)],
+                        "width": pix.width, "height": pix.height
+                    })
+
+        os.replace(shard_path + ".tmp", shard_path)
+    finally:
+        # A chunk that fails leaves no partial shard behind
+        document.close()
+        if os.path.exists(shard_path + ".tmp"):
+            os.remove(shard_path + ".tmp")
+    return records, page_sizes
+
+
+def export_chunks(documents, chunk_size):
+    # (pdf_path, document name, [(page index, labels)]) work units of at most chunk_size pages
+    for (pdf_path, annotations), name in zip(documents, document_names(documents)):
+        pages = annotated_pages(annotations)
+        for first in range(0, len(pages), chunk_size):
+            yield pdf_path, name, pages[first:first + chunk_size]
+
+
+def class_names(documents):
+    return sorted({label["text"] for _, annotations in documents
+                   for _, labels in annotated_pages(annotations) for label in labels})
+
+
+def yolo_lines(records, classes, page_size):
+    page_width, page_height = page_size
+    lines = []
+    for record in records:
+        x0, y0, x1, y1 = record["pdf_rect"]
+        lines.append("{} {:.6f} {:.6f} {:.6f} {:.6f}".format(
+            classes[record["label"]], (x0 + x1) / 2 / page_width, (y0 + y1) / 2 / page_height,
+            (x1 - x0) / page_width, (y1 - y0) / page_height))
+    return lines
+
+
+def coco_dataset(pages, classes, dpi, image_format):
+    # pages: {(document name, page number): (page size in points, records)}
+    scale = dpi / 72
+    coco = {
+        "images": [], "annotations": [],
+        "categories": [{"id": class_id + 1, "name": name} for name, class_id in sorted(classes.items(),
+                                                                                      key=lambda item: item[1])]
+    }
+    for image_id, ((name, page_number), (page_size, records)) in enumerate(sorted(pages.items()), 1):
+        coco["images"].append({
+            "id": image_id, "width": int(round(page_size[0] * scale)), "height": int(round(page_size[1] * scale)),
+            "file_name": "pages/{}_page_{}.{}".format(name, page_number, image_format)
+        })
+        for record in records:
+            x0, y0, x1, y1 = (value * scale for value in record["pdf_rect"])
+            coco["annotations"].append({
+                "id": len(coco["annotations"]) + 1, "image_id": image_id,
+                "category_id": classes[record["label"]] + 1,
+                "bbox": [round(x0, 2), round(y0, 2), round(x1 - x0, 2), round(y1 - y0, 2)],
+                "area": round((x1 - x0) * (y1 - y0), 2), "iscrowd": 0
+            })
+    return coco
+
+
+def run_export(documents, output_dir, dpi=200, image_format="png", workers=None, chunk_size=25,
+               with_pages=False, report=None, cancelled=None, mp_context=None):
+    # documents: [(pdf_path, annotations dict as saved by the tool)]. A chunk that fails is recorded and the rest
+    # carries on. Returns (pages, regions, seconds, cancelled, failed) where failed maps each PDF that failed to
+    # its errors.
+    shard_dir = os.path.join(output_dir, "shards")
+    label_dir = os.path.join(output_dir, "labels")
+    os.makedirs(shard_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+
+    classes = {name: class_id for class_id, name in enumerate(class_names(documents))}
+    chunks = list(export_chunks(documents, chunk_size))
+    total_pages = sum(len(pages) for _, _, pages in chunks)
+    pages_done = 0
+    regions_done = 0
+    coco_pages = {}
+    stopped = False
+    failed = {}
+    start = time.perf_counter()
+
+    with open(os.path.join(output_dir, "manifest.jsonl"), "w") as manifest, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        futures = {executor.submit(export_chunk, pdf_path, name, pages,
+                                   os.path.join(shard_dir, "shard-{:05d}.tar".format(shard_index)),
+                                   dpi, image_format, with_pages): (pdf_path, name, pages)
+                   for shard_index, (pdf_path, name, pages) in enumerate(chunks)}
+        remaining = set(futures)
+        while remaining:
+            done, remaining = wait(remaining, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                pdf_path, name, pages = futures[future]
+                try:
+                    records, page_sizes = future.result()
+                except Exception as error:
+                    page_list = ", ".join(str(page_index + 1) for page_index, _ in pages)
+                    failed.setdefault(pdf_path, []).append(
+                        "pages {}: {}".format(page_list, str(error) or type(error).__name__))
+                    continue
+                for record in records:
+                    record["class"] = classes[record["label"]]
+                    manifest.write(json.dumps(record) + "\n")
+
+                # Label files are written as chunks come in, so a large export needs no second pass
+                for page_index, page_size in page_sizes.items():
+                    page_records = [record for record in records if record["page"] == page_index + 1]
+                    coco_pages[(name, page_index + 1)] = (page_size, page_records)
+                    label_path = os.path.join(label_dir, "{}_page_{}.txt".format(name, page_index + 1))
+                    with open(label_path, "w") as label_file:
+                        label_file.write("".join(line + "\n" for line in yolo_lines(page_records, classes, page_size)))
+
+                pages_done += len(page_sizes)
+                regions_done += len(records)
+            if report:
+                report(pages_done, total_pages, regions_done, time.perf_counter() - start)
+            if not stopped and cancelled is not None and cancelled():
+                # Chunks already rendering still finish and go into the manifest with their shards
+                stopped = True
+                remaining = {future for future in remaining if not future.cancel()}
+
+    classes_path = os.path.join(output_dir, "classes.txt")
+    coco_path = os.path.join(output_dir, "annotations.coco.json")
+    marker_path = os.path.join(output_dir, INCOMPLETE_MARKER)
+    stopped = stopped and pages_done < total_pages  # Cancelled too late to skip anything is a complete export
+    if stopped or failed:
+        # Without these files (an earlier export's included) a cancelled or failed export cannot pass for a
+        # complete one
+        for path in (classes_path, coco_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(marker_path, "w") as marker_file:
+            marker_file.write("Export {} after {} of {} pages. manifest.jsonl and labels/ only cover the "
+                              "exported pages; classes.txt and annotations.coco.json were not written.\n".format(
+                                  "cancelled" if stopped else "failed", pages_done, total_pages))
+            for pdf_path, errors in sorted(failed.items()):
+                marker_file.write("{}: {}\n".format(pdf_path, "; ".join(errors)))
+    else:
+        with open(classes_path, "w") as classes_file:
+            classes_file.write("".join(name + "\n" for name in sorted(classes, key=classes.get)))
+        with open(coco_path, "w") as coco_file:
+            json.dump(coco_dataset(coco_pages, classes, dpi, image_format), coco_file)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+    return pages_done, regions_done, time.perf_counter() - start, stopped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the labeled regions of annotated PDFs as a sharded "
+                                                 "training dataset with COCO and YOLO label files.")
+    parser.add_argument("output_dir", help="directory the dataset is written to")
+    parser.add_argument("--input", nargs=2, action="append", required=True, metavar=("PDF", "ANNOTATIONS"),
+                        help="a PDF and the annotation JSON saved for it; repeat for more documents")
+    parser.add_argument("--dpi", type=int, default=200, help="resolution of the exported crops")
+    parser.add_argument("--format", dest="image_format", default="png", choices=["png", "jpg"],
+                        help="image format of the exported crops")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=25, help="annotated pages per shard")
+    parser.add_argument("--with-pages", action="store_true",
+                        help="also store the full page images the COCO/YOLO boxes refer to")
+    args = parser.parse_args(argv)
+
+    documents = [(pdf_path, load_annotations(annotations_path)) for pdf_path, annotations_path in args.input]
+    pages, regions, elapsed, _, failed = run_export(documents, args.output_dir, dpi=args.dpi,
+                                                    image_format=args.image_format, workers=args.workers,
+                                                    chunk_size=args.chunk_size, with_pages=args.with_pages,
+                                                    report=print_progress)
+    rate = regions / elapsed if elapsed > 0 else 0.0
+    print("\nExported {} regions from {} pages in {:.1f}s ({:.1f} regions/s)".format(
+        regions, pages, elapsed, rate), file=sys.stderr)
+    if failed:
+        print("{} of {} PDFs failed, the dataset is incomplete:".format(len(failed), len(documents)),
+              file=sys.stderr)
+        for pdf_path, errors in sorted(failed.items()):
+            print("  {}: {}".format(pdf_path, "; ".join(errors)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
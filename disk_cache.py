@@ -0,0 +1,120 @@
+import hashlib
+import mmap
+import os
+import threading
+
+# On-disk cache for data derived from a PDF (thumbnails, rendered pages), shared across sessions.
+# Entries live under <cache dir>/<content hash of the PDF>/<name>, so a renamed or copied PDF still
+# hits and an edited one misses. Least recently used entries (by mtime) are deleted once the cache
+# grows past its size limit. No Qt dependency.
+
+CACHE_DIR = os.environ.get("MARKIT_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "markit")
+
+_hashes = {}  # (path, size, mtime) -> content hash
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    # SHA-1 of the file contents, remembered while the file is unchanged on disk
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        digest = _hashes.get(memo_key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as pdf_file:
+            for chunk in iter(lambda: pdf_file.read(1024 * 1024), b""):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        with _hashes_lock:
+            _hashes[memo_key] = digest
+    return digest
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sizes = None  # path -> size of every entry, scanned on first write
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def path(self, doc_hash, name):
+        return os.path.join(self.directory, doc_hash, name)
+
+    def get(self, doc_hash, name):
+        path = self.path(doc_hash, name)
+        try:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            return None
+        return data
+
+    def map(self, doc_hash, name):
+        # Read-only memory map of an entry, for large entries that should not be read into a buffer first
+        path = self.path(doc_hash, name)
+        try:
+            with open(path, "rb") as cache_file:
+                mapping = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (OSError, ValueError):  # ValueError: empty file
+            return None
+        return mapping
+
+    def put(self, doc_hash, name, *chunks):
+        # The chunks (anything supporting the buffer protocol) are written one after another as one entry
+        path = self.path(doc_hash, name)
+        size = 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name so readers never see a partial entry
+            tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp_path, "wb") as cache_file:
+                for chunk in chunks:
+                    size += cache_file.write(chunk)
+            os.replace(tmp_path, path)
+        except OSError:
+            return  # Cache directory not writable, caching is best effort
+        self.added(path, size)
+
+    def added(self, path, size):
+        with self.lock:
+            if self.sizes is None:
+                self.scan()
+            self.total_bytes += size - self.sizes.get(path, 0)
+            self.sizes[path] = size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        # Caller holds self.lock
+        self.sizes = {}
+        self.total_bytes = 0
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    self.sizes[path] = os.path.getsize(path)
+                except OSError:
+                    continue
+                self.total_bytes += self.sizes[path]
+
+    def evict(self):
+        # Caller holds self.lock. Delete oldest entries until 10% below the limit, so not every write evicts.
+        def last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0.0
+
+        target = self.max_bytes * 0.9
+        for path in sorted(self.sizes, key=last_used):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= self.sizes.pop(path)
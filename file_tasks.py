@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from coordinates import sync_label_coordinates
+from render_cache import FITZ_LOCK, RENDER_ZOOM
+from workspace import open_session
+
+# Opening PDFs and loading or saving annotation files runs on a background worker so the window stays
+# responsive. Jobs report progress through their task and stop at the next report once cancelled.
+# They never touch widgets or the scene, and the only journal work they do is compacting it: opening a
+# PDF creates its journal and compacts it when needed, saving compacts it afterwards. compact() is safe
+# off the GUI thread while edits are recorded. AnnotationApp applies the results on the GUI thread, and
+# the synchronous *_file methods run the same jobs inline (with a task that has no runner).
+
+REPORT_INTERVAL = 0.05  # Seconds between progress signals, so long loops do not flood the event queue
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class FileTask:
+    def __init__(self, kind, path, runner=None):
+        self.kind = kind  # "open_pdf", "load_annotations", "merge_annotations" or "save_annotations"
+        self.path = path
+        self.runner = runner
+        self.cancel_event = threading.Event()
+        self.last_report = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise TaskCancelled()
+
+    def report(self, message, done=0, total=0):
+        # total of 0 means the amount of work is not known
+        self.check()
+        now = time.monotonic()
+        if self.runner is not None and (now - self.last_report >= REPORT_INTERVAL or done == 0):
+            self.last_report = now
+            self.runner.progress.emit(self, message, done, total)
+
+
+class FileTaskRunner(QObject):
+    # Emitted from the worker thread, delivered on the GUI thread
+    progress = pyqtSignal(object, str, int, int)
+    finished = pyqtSignal(object, object)  # Task and its result, None when it was cancelled
+    failed = pyqtSignal(object, str)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-io")
+
+    def start(self, kind, path, job, *args):
+        task = FileTask(kind, path, self)
+        self.executor.submit(self._run, task, job, args)
+        return task
+
+    def _run(self, task, job, args):
+        try:
+            result = job(task, task.path, *args)
+        except TaskCancelled:
+            result = None
+        except Exception as error:
+            self.failed.emit(task, str(error) or type(error).__name__)
+            return
+        self.finished.emit(task, result)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def sync_page_coordinates(document, page_index, labels):
+    # Give every label its rect in PDF points as well as its scene position on this page
+    with FITZ_LOCK:
+        if document is None or not 0 <= page_index < len(document):
+            return
+        page_rect = document.load_page(page_index).rect
+    for label in labels:
+        sync_label_coordinates(label, page_rect)
+
+
+def open_document_job(task, path, render_cache):
+    # Open the PDF with its journal and render the first page (or take it from the disk cache), which is
+    # all the window needs to show it. Returns (session, first page image).
+    task.report("Opening {}".format(os.path.basename(path)))
+    with FITZ_LOCK:
+        document = fitz.open(path)  # First, so a file that is not a PDF leaves no journal behind
+        page_count = len(document)
+    session = open_session(path)
+    session.document = document
+    try:
+        task.report("Rendering page 1")
+        image = render_cache.render(session.document, path, 0, RENDER_ZOOM) if page_count else None
+        task.check()
+    except BaseException:
+        with FITZ_LOCK:
+            document.close()
+        if session.journal is not None:
+            session.journal.close()
+        raise
+    return session, image
+
+
+def read_annotations_job(task, path, document):
+    # Parse an annotation file and fill in the coordinates its labels lack, returns the parsed dict
+    task.report("Reading {}".format(os.path.basename(path)))
+    with open(path, "r") as json_file:
+        loaded_annotations = json.load(json_file)
+
+    pages = list(loaded_annotations.items())
+    for idx, (page_number, data) in enumerate(pages):
+        task.report("Placing labels", idx, len(pages))
+        sync_page_coordinates(document, int(page_number) - 1, data["labels"])
+    return loaded_annotations
+
+
+def write_annotations_job(task, path, annotations, journal=None):
+    # Write the same JSON as json.dump(annotations, indent=4), one page at a time, then swap it in
+    # so a cancelled or failed save leaves the previous file intact. annotations is a dict or an
+    # AnnotationStore, whose label dicts are only built page by page here. Once saved, the document's
+    # journal is compacted here too rather than on the GUI thread.
+    page_count = len(annotations)
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as json_file:
+            if not page_count:
+                json_file.write("{}")
+            else:
+                json_file.write("{\n")
+                for idx, (page_number, data) in enumerate(annotations.items()):
+                    task.report("Saving", idx, page_count)
+                    entry = json.dumps({page_number: data}, indent=4)[2:-2]  # Without the enclosing braces
+                    json_file.write(entry + (",\n" if idx < page_count - 1 else "\n"))
+                json_file.write("}")
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if journal is not None:
+        journal.compact()
+    return path
@@ -0,0 +1,139 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+# Opt-in timing of the tool's hot paths. Set MARKIT_PROFILE=1 to enable it; MARKIT_TRACE may name the
+# trace file, which is written as Chrome trace-event JSON (open it in chrome://tracing or Perfetto).
+# When disabled, profiler.span() hands back a shared no-op context manager, so instrumented code
+# costs one attribute check. No Qt dependency.
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Profiler:
+    def __init__(self, history=200, max_events=500000):
+        self.enabled = False
+        self.trace_path = None
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.dropped_events = 0
+        self.durations = defaultdict(lambda: deque(maxlen=history))  # Span name -> recent durations in ms
+        self.thread_names = {}
+        self.marks = {}
+
+    def enable(self, trace_path=None):
+        self.enabled = True
+        self.trace_path = trace_path or os.path.join(
+            os.getcwd(), "markit_trace_{}.json".format(time.strftime("%Y%m%d_%H%M%S")))
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def mark(self, name):
+        # Start of a span that ends in a different call, closed with finish(name)
+        if self.enabled:
+            self.marks[name] = time.perf_counter()
+
+    def finish(self, name, **args):
+        start = self.marks.pop(name, None)
+        if start is not None:
+            self.record(name, start, time.perf_counter(), args)
+
+    def record(self, name, start, end, args=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+            "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.durations[name].append((end - start) * 1000)
+            self.thread_names.setdefault(thread.ident, thread.name)
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            else:
+                self.dropped_events += 1
+
+    def summary(self):
+        with self.lock:
+            durations = {name: list(samples) for name, samples in self.durations.items()}
+        stats = {}
+        for name, samples in sorted(durations.items()):
+            ordered = sorted(samples)
+            stats[name] = {
+                "count": len(ordered),
+                "last_ms": samples[-1],
+                "mean_ms": sum(ordered) / len(ordered),
+                "p95_ms": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                "max_ms": ordered[-1]
+            }
+        return stats
+
+    def write_trace(self, path=None):
+        path = path or self.trace_path
+        with self.lock:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                        for ident, name in self.thread_names.items()]
+            trace = {"traceEvents": metadata + self.events, "displayTimeUnit": "ms",
+                     "otherData": {"dropped_events": self.dropped_events}}
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+        return path
+
+
+# Shared by the GUI and the render threads
+profiler = Profiler()
+
+
+def profiled(name):
+    # Time every call of a method; only for methods that are not connected to Qt signals,
+    # since the wrapper hides the real signature from PyQt's slot matching
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with Span(profiler, name, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable_from_environment():
+    if os.environ.get("MARKIT_PROFILE"):
+        profiler.enable(os.environ.get("MARKIT_TRACE"))
+    return profiler.enabled
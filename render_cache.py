@@ -0,0 +1,248 @@
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PyQt5 import sip
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+from coordinates import SCENE_WIDTH, SCENE_HEIGHT
+from disk_cache import file_hash
+from instrumentation import profiler
+
+RENDER_ZOOM = 2.0
+
+# Rendered pages on disk are raw RGB888 rows behind a small header: magic, width, height, bytes per line
+BITMAP_HEADER = struct.Struct("<4sIII")
+BITMAP_MAGIC = b"MKP1"
+
+# MuPDF shares one context between all documents, so every call into fitz is serialized
+FITZ_LOCK = threading.RLock()
+
+
+def render_page_image(document, page_number, zoom):
+    # Rasterize the page and fit it into the scene size, returning a QImage that owns its pixels
+    with profiler.span("rasterize", page=page_number + 1), FITZ_LOCK:
+        page = document.load_page(page_number)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    qt_image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
+    with profiler.span("smooth_scale", page=page_number + 1):
+        scaled = qt_image.scaled(SCENE_WIDTH, SCENE_HEIGHT, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    if scaled.size() == qt_image.size():
+        # scaled() hands back a shallow copy when nothing changes, which still points at pix.samples
+        scaled = scaled.copy()
+    return scaled
+
+
+def bitmap_name(page_number, zoom):
+    # The stored image depends on the render matrix and on the box it was fitted into
+    return "page{}_z{:g}_{}x{}.rgb".format(page_number, zoom, SCENE_WIDTH, SCENE_HEIGHT)
+
+
+def image_from_mapping(mapping):
+    # Build the QImage on the mapped file and copy it out once, instead of rasterizing the page again
+    if len(mapping) < BITMAP_HEADER.size:
+        return None
+    magic, width, height, bytes_per_line = BITMAP_HEADER.unpack_from(mapping)
+    if magic != BITMAP_MAGIC or len(mapping) != BITMAP_HEADER.size + height * bytes_per_line:
+        return None
+    pixels = sip.voidptr(memoryview(mapping)[BITMAP_HEADER.size:])
+    return QImage(pixels, width, height, bytes_per_line, QImage.Format_RGB888).copy()
+
+
+def image_bitmap_chunks(image):
+    image = image.convertToFormat(QImage.Format_RGB888)
+    pixels = image.constBits()
+    pixels.setsize(image.sizeInBytes())
+    header = BITMAP_HEADER.pack(BITMAP_MAGIC, image.width(), image.height(), image.bytesPerLine())
+    return header, bytes(pixels)
+
+
+class PageRenderCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, prefetch_radius=2, max_workers=2, budget=None,
+                 disk_cache=None):
+        self.max_bytes = max_bytes
+        self.budget = budget  # Shared MemoryBudget of the workspace, replaces max_bytes when set
+        self.disk_cache = disk_cache  # Rendered pages kept across sessions, keyed by the PDF's content hash
+        self.prefetch_radius = prefetch_radius
+        self.document = None
+        self.doc_key = None
+        self.path = None
+        self.doc_hash = None
+        self.images = OrderedDict()  # (doc_key, page, zoom) -> QImage, least recently used first
+        self.total_bytes = 0
+        self.pending = {}  # (doc_key, page, zoom) -> Future
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="page-render")
+
+    def set_document(self, document, doc_key, path=None):
+        with self.lock:
+            # Drop queued prefetches for the previous document, finished renders are discarded by generation
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.generation += 1
+            self.document = document
+            self.doc_key = doc_key
+            self.path = path
+            self.doc_hash = None  # Hashed on first use, by whichever thread gets there first
+
+    def get(self, page_number, zoom):
+        key = (self.doc_key, page_number, zoom)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            future = self.pending.get(key)
+        if image is not None:
+            if self.budget is not None:
+                self.budget.touch(self, key)
+            return image
+
+        if future is not None and not future.cancelled():
+            # Already being rendered in the background, wait for it instead of rendering twice
+            with profiler.span("wait_for_prefetch", page=page_number + 1):
+                image = future.result()
+            if image is not None:
+                return image
+
+        image, rendered = self._load_image(self.document, self.path, page_number, zoom)
+        with self.lock:
+            self._store(key, image)
+        self._charge(key, image)
+        if rendered:
+            # Written by a worker so the flip does not wait on the disk
+            self.executor.submit(self._write_bitmap, self.path, page_number, zoom, image)
+        return image
+
+    def insert(self, doc_key, page_number, zoom, image):
+        # A page rendered elsewhere, e.g. while its document was being opened
+        key = (doc_key, page_number, zoom)
+        with self.lock:
+            self._store(key, image)
+        self._charge(key, image)
+
+    def prefetch(self, page_number, zoom):
+        if self.document is None:
+            return
+        page_count = len(self.document)
+        # Nearest neighbours first, so the next and previous page are ready before the rest
+        for distance in range(1, self.prefetch_radius + 1):
+            for neighbour in (page_number + distance, page_number - distance):
+                if 0 <= neighbour < page_count:
+                    self._schedule(neighbour, zoom)
+
+    def _schedule(self, page_number, zoom):
+        key = (self.doc_key, page_number, zoom)
+        with self.lock:
+            if key in self.images or key in self.pending:
+                return
+            future = self.executor.submit(self._render_job, self.document, self.path, key, self.generation)
+            self.pending[key] = future
+
+    def render(self, document, path, page_number, zoom):
+        # A page of any document from the disk cache, or rendered and written back, without keeping it in
+        # memory. Safe to call from any thread.
+        image, rendered = self._load_image(document, path, page_number, zoom)
+        if rendered:
+            self._write_bitmap(path, page_number, zoom, image)
+        return image
+
+    def _render_job(self, document, path, key, generation):
+        try:
+            image = self.render(document, path, key[1], key[2])
+        except Exception:
+            image = None
+        with self.lock:
+            self.pending.pop(key, None)
+            stored = image is not None and generation == self.generation
+            if stored:
+                self._store(key, image)
+        if stored:
+            self._charge(key, image)
+        return image
+
+    def _document_hash(self, path):
+        if self.disk_cache is None or path is None:
+            return None
+        if path == self.path and self.doc_hash is not None:
+            return self.doc_hash
+        try:
+            doc_hash = file_hash(path)
+        except OSError:
+            return None
+        if path == self.path:
+            self.doc_hash = doc_hash
+        return doc_hash
+
+    def _load_image(self, document, path, page_number, zoom):
+        # The page from the disk cache if it was rendered in an earlier session, else a fresh render.
+        # Returns (image, rendered).
+        doc_hash = self._document_hash(path)
+        if doc_hash is not None:
+            mapping = self.disk_cache.map(doc_hash, bitmap_name(page_number, zoom))
+            if mapping is not None:
+                with profiler.span("disk_cache_read", page=page_number + 1):
+                    try:
+                        image = image_from_mapping(mapping)
+                    finally:
+                        mapping.close()
+                if image is not None:
+                    return image, False
+        return render_page_image(document, page_number, zoom), True
+
+    def _write_bitmap(self, path, page_number, zoom, image):
+        doc_hash = self._document_hash(path)
+        if doc_hash is not None:
+            self.disk_cache.put(doc_hash, bitmap_name(page_number, zoom), *image_bitmap_chunks(image))
+
+    def _store(self, key, image):
+        # Caller holds self.lock
+        if key in self.images:
+            self.total_bytes -= self.images.pop(key).sizeInBytes()
+        self.images[key] = image
+        self.total_bytes += image.sizeInBytes()
+        if self.budget is not None:
+            return
+        # Evict least recently used pages until we are back under budget, always keeping the newest one
+        while self.total_bytes > self.max_bytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.total_bytes -= evicted.sizeInBytes()
+
+    def _charge(self, key, image):
+        # Outside self.lock, the shared budget may call back into evict() for this or any other cache
+        if self.budget is not None:
+            self.budget.charge(self, key, image.sizeInBytes())
+
+    def evict(self, key):
+        # Called by the shared budget, possibly from a render thread
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.total_bytes -= image.sizeInBytes()
+
+    def drop_document(self, doc_key):
+        # Free every page rendered for a document that was closed
+        with self.lock:
+            keys = [key for key in self.images if key[0] == doc_key]
+            for key in keys:
+                self.total_bytes -= self.images.pop(key).sizeInBytes()
+        if self.budget is not None:
+            for key in keys:
+                self.budget.release(self, key)
+
+    def clear(self):
+        with self.lock:
+            keys = list(self.images)
+            self.images.clear()
+            self.total_bytes = 0
+        if self.budget is not None:
+            for key in keys:
+                self.budget.release(self, key)
+
+    def shutdown(self):
+        self.set_document(None, None)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,84 @@
+import itertools
+from collections import defaultdict
+
+
+class GridIndex:
+    # Uniform grid over scene coordinates; every key is registered in each cell its rectangle touches
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)  # (column, row) -> keys
+        self.rects = {}  # key -> (x0, y0, x1, y1)
+        self.order = {}  # key -> insertion sequence, later keys are drawn on top
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __contains__(self, key):
+        return key in self.rects
+
+    def insert(self, key, x, y, width, height):
+        if key in self.rects:
+            self.remove(key)
+        # Boxes drawn from bottom-right to top-left have negative sizes
+        rect = (min(x, x + width), min(y, y + height), max(x, x + width), max(y, y + height))
+        self.rects[key] = rect
+        self.order[key] = next(self.counter)
+        for cell in self._cells_for(*rect):
+            self.cells[cell].add(key)
+
+    def remove(self, key):
+        rect = self.rects.pop(key, None)
+        if rect is None:
+            return
+        del self.order[key]
+        for cell in self._cells_for(*rect):
+            bucket = self.cells.get(cell)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.rects.clear()
+        self.order.clear()
+
+    def rect(self, key):
+        return self.rects.get(key)
+
+    def at_point(self, x, y):
+        # Keys whose rectangle contains the point, topmost first
+        bucket = self.cells.get(self._cell(x, y), ())
+        hits = [key for key in bucket if self._contains(self.rects[key], x, y)]
+        hits.sort(key=self.order.__getitem__, reverse=True)
+        return hits
+
+    def overlapping(self, x, y, width, height):
+        # Keys whose rectangle intersects the query rectangle, topmost first
+        x0, y0 = min(x, x + width), min(y, y + height)
+        x1, y1 = max(x, x + width), max(y, y + height)
+        seen = set()
+        for cell in self._cells_for(x0, y0, x1, y1):
+            seen.update(self.cells.get(cell, ()))
+        hits = [key for key in seen if self._intersects(self.rects[key], x0, y0, x1, y1)]
+        hits.sort(key=self.order.__getitem__, reverse=True)
+        return hits
+
+    def _cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def _cells_for(self, x0, y0, x1, y1):
+        col0, row0 = self._cell(x0, y0)
+        col1, row1 = self._cell(x1, y1)
+        for col in range(col0, col1 + 1):
+            for row in range(row0, row1 + 1):
+                yield col, row
+
+    @staticmethod
+    def _contains(rect, x, y):
+        return rect[0] <= x <= rect[2] and rect[1] <= y <= rect[3]
+
+    @staticmethod
+    def _intersects(rect, x0, y0, x1, y1):
+        return rect[0] <= x1 and x0 <= rect[2] and rect[1] <= y1 and y0 <= rect[3]
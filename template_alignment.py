@@ -0,0 +1,88 @@
+import fitz  # PyMuPDF
+import numpy as np
+
+from coordinates import scene_scale
+
+# Copies one page's labels onto other pages of a repeated layout. Each page is rendered at low
+# resolution and reduced to ink projection profiles (ink per row and per column); the offset and
+# scale of a page against the template page are found per axis by cross-correlating the profiles
+# for a range of candidate scales at once. No Qt dependency.
+
+PROFILE_SCALE = 0.25  # Render at a quarter of the scene resolution
+INK_THRESHOLD = 160
+SCALES = np.linspace(0.9, 1.1, 41)  # Candidate scale factors, relative to the template page
+# Lowest profile correlation trusted as the same layout. Matching pages score close to 1, a different
+# form around 0.25 and a blank page 0.
+MIN_SCORE = 0.5
+
+
+def ink_profiles(page):
+    # Row and column ink profiles of a page, sampled at PROFILE_SCALE scene pixels
+    zoom = scene_scale(page.rect.width, page.rect.height) * PROFILE_SCALE
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    ink = (gray < INK_THRESHOLD).astype(np.float32)
+    return ink.sum(axis=1), ink.sum(axis=0)
+
+
+def align_profile(template, target, scales=SCALES):
+    # Find scale s and offset d so that target(v) ~ template((v - d) / s), for every scale in one go
+    size = max(len(template), len(target))
+    positions = np.arange(size, dtype=np.float32)
+
+    # Template stretched by each candidate scale about the origin, one row per scale
+    stretched = np.interp(positions[None, :] / scales[:, None], np.arange(len(template)), template, right=0.0)
+    stretched -= stretched.mean(axis=1, keepdims=True)
+    target = np.pad(target, (0, size - len(target))) - target.mean()
+
+    # Circular cross-correlation through the FFT, zero padded so shifts do not wrap around
+    padded = 2 * size
+    spectrum = np.fft.rfft(target, padded)[None, :] * np.conj(np.fft.rfft(stretched, padded, axis=1))
+    correlation = np.fft.irfft(spectrum, padded, axis=1)
+    norms = np.linalg.norm(stretched, axis=1) * np.linalg.norm(target)
+    correlation /= np.where(norms > 0, norms, 1.0)[:, None]
+
+    scale_idx, lag = np.unravel_index(np.argmax(correlation), correlation.shape)
+    if lag >= size:
+        lag -= padded
+    return float(scales[scale_idx]), float(lag), float(correlation[scale_idx, lag])
+
+
+def estimate_transform(template_profiles, target_profiles):
+    # Per axis scale and offset in scene pixels
+    scale_y, offset_y, score_y = align_profile(template_profiles[0], target_profiles[0])
+    scale_x, offset_x, score_x = align_profile(template_profiles[1], target_profiles[1])
+    return {
+        "scale_x": scale_x, "offset_x": offset_x / PROFILE_SCALE,
+        "scale_y": scale_y, "offset_y": offset_y / PROFILE_SCALE,
+        "score": min(score_x, score_y)
+    }
+
+
+def transform_labels(labels, transform):
+    if not labels:
+        return []
+    boxes = np.array([[label["position"]["x"], label["position"]["y"],
+                       label["position"]["width"], label["position"]["height"]] for label in labels], dtype=np.float64)
+    boxes[:, 0] = boxes[:, 0] * transform["scale_x"] + transform["offset_x"]
+    boxes[:, 1] = boxes[:, 1] * transform["scale_y"] + transform["offset_y"]
+    boxes[:, 2] *= transform["scale_x"]
+    boxes[:, 3] *= transform["scale_y"]
+    boxes = np.rint(boxes).astype(int)
+    return [{
+        "position": {"x": int(x), "y": int(y), "width": int(width), "height": int(height)},
+        "text": label["text"]
+    } for label, (x, y, width, height) in zip(labels, boxes)]
+
+
+def propagate_template(document, template_page, labels, target_pages, min_score=MIN_SCORE):
+    # Returns {page index: (transformed labels, transform)} for every target page index. Pages that do not
+    # align with the template (blank, another form, a failed scan) get no labels and transform["aligned"]
+    # is False for them.
+    template_profiles = ink_profiles(document.load_page(template_page))
+    results = {}
+    for page_index in target_pages:
+        transform = estimate_transform(template_profiles, ink_profiles(document.load_page(page_index)))
+        transform["aligned"] = transform["score"] >= min_score
+        results[page_index] = (transform_labels(labels, transform) if transform["aligned"] else [], transform)
+    return results
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QColor
+from PyQt5.QtWidgets import QListView
+
+from disk_cache import file_hash
+from render_cache import FITZ_LOCK
+
+THUMB_WIDTH = 96  # Fitted into a 2:3 box like the page scene, roughly 12 DPI for an A4 page
+THUMB_HEIGHT = 144
+MARGIN_ROWS = 4  # Rows above and below the visible ones rendered ahead of scrolling
+MAX_PIXMAPS = 600  # Thumbnails kept in memory per document, the rest reload from the disk cache
+MAX_DOCUMENTS = 4
+
+
+class ThumbnailModel(QAbstractListModel):
+    def __init__(self, placeholder):
+        super().__init__()
+        self.placeholder = placeholder
+        self.page_count = 0
+        self.pixmaps = OrderedDict()  # row -> QPixmap, least recently used first
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.page_count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return str(index.row() + 1)
+        if role == Qt.DecorationRole:
+            return self.pixmaps.get(index.row(), self.placeholder)
+        return None
+
+    def reset(self, page_count, pixmaps):
+        self.beginResetModel()
+        self.page_count = page_count
+        self.pixmaps = pixmaps
+        self.endResetModel()
+
+    def set_pixmap(self, row, pixmap):
+        self.pixmaps[row] = pixmap
+        self.pixmaps.move_to_end(row)
+        while len(self.pixmaps) > MAX_PIXMAPS:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class ThumbnailStrip(QListView):
+    # Page previews next to the buttons. The list is virtualized: thumbnails are rendered in the
+    # background only for the rows in (or near) view, and cached on disk by the PDF's content hash.
+    thumbnail_ready = pyqtSignal(object, QImage)  # Emitted from the render thread
+    page_selected = pyqtSignal(int)
+
+    def __init__(self, disk_cache=None):
+        super().__init__()
+        self.disk_cache = disk_cache
+        placeholder = QPixmap(THUMB_WIDTH, THUMB_HEIGHT)
+        placeholder.fill(QColor(60, 60, 60))
+        self.thumbnails = ThumbnailModel(placeholder)
+        self.setModel(self.thumbnails)
+
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.TopToBottom)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)  # Lets the view lay out hundreds of rows without asking each one
+        self.setIconSize(QSize(THUMB_WIDTH, THUMB_HEIGHT))
+        self.setSpacing(4)
+        self.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.setFixedWidth(THUMB_WIDTH + 40)
+        self.setFocusPolicy(Qt.NoFocus)  # Keep the A/D page keys with the main window
+
+        self.document = None
+        self.doc_key = None
+        self.path = None
+        self.generation = 0
+        self.wanted = frozenset()
+        self.pending = set()
+        self.documents = OrderedDict()  # doc_key -> thumbnails of a document switched away from
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnail-render")
+
+        self.thumbnail_ready.connect(self.on_thumbnail_ready)
+        self.clicked.connect(lambda index: self.page_selected.emit(index.row()))
+        self.verticalScrollBar().valueChanged.connect(self.schedule_visible)
+
+    def set_document(self, document, doc_key, path):
+        if self.doc_key is not None:
+            self.documents[self.doc_key] = self.thumbnails.pixmaps
+            self.documents.move_to_end(self.doc_key)
+            while len(self.documents) > MAX_DOCUMENTS:
+                self.documents.popitem(last=False)
+        self.generation += 1  # Queued renders of the previous document are skipped
+        self.pending = set()
+        self.document = document
+        self.doc_key = doc_key
+        self.path = path
+        self.thumbnails.reset(len(document) if document is not None else 0,
+                              self.documents.pop(doc_key, None) or OrderedDict())
+        # Rows are only laid out once control returns to the event loop
+        QTimer.singleShot(0, self.schedule_visible)
+
+    def drop_document(self, doc_key):
+        self.documents.pop(doc_key, None)
+
+    def set_current(self, page_number):
+        index = self.thumbnails.index(page_number)
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
+        self.schedule_visible()
+
+    def visible_rows(self):
+        if self.thumbnails.page_count == 0:
+            return range(0)
+        # Rows have a uniform size, so the visible range follows from the first row's position
+        first_rect = self.visualRect(self.thumbnails.index(0))
+        if self.thumbnails.page_count > 1:
+            pitch = self.visualRect(self.thumbnails.index(1)).top() - first_rect.top()
+        else:
+            pitch = first_rect.height()
+        if pitch <= 0:
+            return range(0)
+        first = max(0, -first_rect.top() // pitch - MARGIN_ROWS)
+        last = min(self.thumbnails.page_count,
+                   -first_rect.top() // pitch + self.viewport().height() // pitch + 2 + MARGIN_ROWS)
+        return range(first, last)
+
+    def schedule_visible(self):
+        if self.document is None:
+            return
+        rows = self.visible_rows()
+        self.wanted = frozenset(rows)
+        # Top to bottom of the view, so thumbnails fill in the reading order
+        for row in rows:
+            key = (self.generation, row)
+            if row in self.thumbnails.pixmaps or key in self.pending:
+                continue
+            self.pending.add(key)
+            self.executor.submit(self._render_job, self.document, self.path, key)
+
+    def _render_job(self, document, path, key):
+        generation, row = key
+        if generation != self.generation or row not in self.wanted:
+            # Scrolled past before the worker got to it
+            self.thumbnail_ready.emit(key, QImage())
+            return
+        try:
+            image = self._load_thumbnail(document, path, row)
+        except Exception:
+            image = QImage()
+        self.thumbnail_ready.emit(key, image)
+
+    def _load_thumbnail(self, document, path, row):
+        name = "thumb_{}x{}_{}.png".format(THUMB_WIDTH, THUMB_HEIGHT, row)
+        doc_hash = None
+        if self.disk_cache is not None:
+            doc_hash = file_hash(path)
+            data = self.disk_cache.get(doc_hash, name)
+            if data is not None:
+                image = QImage.fromData(data, "PNG")
+                if not image.isNull():
+                    return image
+
+        with FITZ_LOCK:
+            page = document.load_page(row)
+            zoom = min(THUMB_WIDTH / page.rect.width, THUMB_HEIGHT / page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            png = pix.tobytes("png")
+        image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888).copy()
+        if doc_hash is not None:
+            self.disk_cache.put(doc_hash, name, png)
+        return image
+
+    def on_thumbnail_ready(self, key, image):
+        self.pending.discard(key)
+        generation, row = key
+        if generation == self.generation and not image.isNull():
+            self.thumbnails.set_pixmap(row, QPixmap.fromImage(image))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.schedule_visible()
+
+    def shutdown(self):
+        self.generation += 1
+        self.document = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,174 @@
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PyQt5.QtCore import QObject, QRectF, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QGraphicsPixmapItem
+
+from coordinates import scene_scale
+from render_cache import FITZ_LOCK
+
+TILE_PIXELS = 512  # Edge length of a rendered tile in device pixels
+MAX_LEVEL = 16  # Deepest zoom level tiles are rendered at (device pixels per scene pixel)
+TILE_Z = -1  # Above the base page pixmap, below the annotation boxes
+
+
+class TileRenderer(QObject):
+    # Emitted from the render thread, delivered on the GUI thread
+    tile_ready = pyqtSignal(object, QImage)
+
+    def __init__(self, scene, max_bytes=96 * 1024 * 1024):
+        super().__init__()
+        self.scene = scene
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()  # (doc_key, page, level, col, row) -> QPixmap, least recently used first
+        self.total_bytes = 0
+        self.items = {}  # (level, col, row) -> QGraphicsPixmapItem currently in the scene
+        self.wanted = set()
+        self.pending = {}  # key -> Future of tiles queued or rendering
+        self.document = None
+        self.doc_key = None
+        self.page_number = None
+        self.page_rect = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tile-render")
+        self.tile_ready.connect(self.on_tile_ready)
+
+    def set_document(self, document, doc_key):
+        self.document = document
+        self.doc_key = doc_key
+        self.page_number = None
+        self.items = {}
+        self.wanted = set()
+        self._cancel_stale()
+
+    def set_page(self, page_number):
+        # Called after scene.clear(), which already deleted the previous page's tile items
+        self.items = {}
+        self.wanted = set()
+        self.page_number = page_number
+        with FITZ_LOCK:
+            self.page_rect = self.document.load_page(page_number).rect
+        self._cancel_stale()
+
+    def update_view(self, visible_rect, view_scale):
+        if self.document is None or self.page_number is None:
+            return
+        if view_scale <= 1.0:
+            # The base page pixmap already has at least one pixel per screen pixel
+            self._remove_items(lambda tile: True)
+            self.wanted = set()
+            self._cancel_stale()
+            return
+
+        # Quantize to powers of two so small zoom steps reuse the same tiles
+        level = min(MAX_LEVEL, 2 ** math.ceil(math.log2(view_scale)))
+        span = TILE_PIXELS / level  # Scene pixels covered by one tile
+        scale = scene_scale(self.page_rect.width, self.page_rect.height)
+        page_scene_rect = QRectF(0, 0, self.page_rect.width * scale, self.page_rect.height * scale)
+        visible = visible_rect.intersected(page_scene_rect)
+        if visible.isEmpty():
+            return
+
+        self.wanted = {(level, col, row)
+                       for col in range(int(visible.left() // span), int(visible.right() // span) + 1)
+                       for row in range(int(visible.top() // span), int(visible.bottom() // span) + 1)}
+        self._cancel_stale()
+        for tile in self.wanted:
+            if tile in self.items:
+                continue
+            pixmap = self._cached(tile)
+            if pixmap is None:
+                self._schedule(tile)
+            else:
+                self._show(tile, pixmap)
+
+        # Tiles of the current level that scrolled away go now, other levels once this one is complete
+        self._remove_items(lambda tile: tile[0] == level and tile not in self.wanted)
+        self._retire_other_levels()
+
+    def on_tile_ready(self, key, image):
+        self.pending.pop(key, None)
+        pixmap = QPixmap.fromImage(image)
+        self._store(key, pixmap)
+
+        tile = key[2:]
+        if key[:2] == (self.doc_key, self.page_number) and tile in self.wanted and tile not in self.items:
+            self._show(tile, pixmap)
+            self._retire_other_levels()
+
+    def _retire_other_levels(self):
+        # Lower-resolution tiles stay up as placeholders until every wanted tile has been upgraded
+        if self.wanted and all(tile in self.items for tile in self.wanted):
+            level = next(iter(self.wanted))[0]
+            self._remove_items(lambda tile: tile[0] != level)
+
+    def _cached(self, tile):
+        key = (self.doc_key, self.page_number) + tile
+        pixmap = self.tiles.get(key)
+        if pixmap is not None:
+            self.tiles.move_to_end(key)
+        return pixmap
+
+    def _store(self, key, pixmap):
+        if key in self.tiles:
+            self.total_bytes -= self._pixmap_bytes(self.tiles.pop(key))
+        self.tiles[key] = pixmap
+        self.total_bytes += self._pixmap_bytes(pixmap)
+        while self.total_bytes > self.max_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.total_bytes -= self._pixmap_bytes(evicted)
+
+    @staticmethod
+    def _pixmap_bytes(pixmap):
+        return pixmap.width() * pixmap.height() * 4
+
+    def _schedule(self, tile):
+        key = (self.doc_key, self.page_number) + tile
+        if key in self.pending:
+            return
+        self.pending[key] = self.executor.submit(self._render_job, self.document, self.page_rect, key)
+
+    def _cancel_stale(self):
+        # Drop queued tiles of another page, zoom level or viewport so fast panning and zooming never leaves
+        # the visible tiles waiting behind them; a tile already rendering finishes and is only cached
+        current = (self.doc_key, self.page_number)
+        for key, future in list(self.pending.items()):
+            if (key[:2] != current or key[2:] not in self.wanted) and future.cancel():
+                del self.pending[key]
+
+    def _render_job(self, document, page_rect, key):
+        _, page_number, level, col, row = key
+        span = TILE_PIXELS / level
+        scale = scene_scale(page_rect.width, page_rect.height)
+        clip = fitz.Rect(page_rect.x0 + col * span / scale, page_rect.y0 + row * span / scale,
+                         page_rect.x0 + (col + 1) * span / scale, page_rect.y0 + (row + 1) * span / scale) & page_rect
+        try:
+            with FITZ_LOCK:
+                page = document.load_page(page_number)
+                pix = page.get_pixmap(matrix=fitz.Matrix(scale * level, scale * level), clip=clip)
+            image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888).copy()
+        except Exception:
+            image = QImage()
+        self.tile_ready.emit(key, image)
+
+    def _show(self, tile, pixmap):
+        if pixmap.isNull():
+            return
+        level, col, row = tile
+        span = TILE_PIXELS / level
+        item = QGraphicsPixmapItem(pixmap)
+        item.setPos(col * span, row * span)
+        item.setScale(1 / level)
+        item.setZValue(TILE_Z)
+        self.scene.addItem(item)
+        self.items[tile] = item
+
+    def _remove_items(self, predicate):
+        for tile in [tile for tile in self.items if predicate(tile)]:
+            self.scene.removeItem(self.items.pop(tile))
+
+    def shutdown(self):
+        self.document = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
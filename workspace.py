@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+from annotation_journal import AnnotationJournal
+from annotation_store import AnnotationStore, CommandLog
+from render_cache import FITZ_LOCK
+
+# Several PDFs open side by side (one per student when grading back to back). Each document keeps
+# its annotations, journal and current page; the fitz handle is opened lazily and closed again when
+# the document has been idle for a while. Rendered pages and overlays of all documents share one
+# MemoryBudget, so switching between students is fast without memory growing without bound.
+
+
+class MemoryBudget:
+    # One byte budget shared by several caches. Each cache charges its entries as (owner, key, size)
+    # and implements evict(key); the least recently used entries are evicted first, whichever cache
+    # they belong to. Owners are called outside the budget's lock, so they may hold their own lock
+    # while charging.
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (owner, key) -> size, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def charge(self, owner, key, size):
+        with self.lock:
+            previous = self.entries.pop((owner, key), None)
+            if previous is not None:
+                self.total_bytes -= previous
+            self.entries[(owner, key)] = size
+            self.total_bytes += size
+
+            victims = []
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                (victim_owner, victim_key), victim_size = self.entries.popitem(last=False)
+                self.total_bytes -= victim_size
+                victims.append((victim_owner, victim_key))
+
+        for victim_owner, victim_key in victims:
+            victim_owner.evict(victim_key)
+
+    def touch(self, owner, key):
+        with self.lock:
+            if (owner, key) in self.entries:
+                self.entries.move_to_end((owner, key))
+
+    def release(self, owner, key):
+        with self.lock:
+            size = self.entries.pop((owner, key), None)
+            if size is not None:
+                self.total_bytes -= size
+
+
+class DocumentSession:
+    def __init__(self, path):
+        self.path = path
+        self.key = os.path.abspath(path)
+        self.name = os.path.basename(path)
+        self.document = None  # fitz.Document while open
+        self.annotations = AnnotationStore()
+        self.history = CommandLog()
+        self.journal = None
+        self.materialized_pages = set()  # Pages whose journal events are already in self.annotations
+        self.current_page = 0
+        self.last_used = time.monotonic()
+
+
+def open_session(path):
+    # A new session with its journal, safe to call from a worker thread
+    session = DocumentSession(path)
+    try:
+        # Work from an earlier session (or one that crashed) is replayed page by page from the journal
+        session.journal = AnnotationJournal(path + ".markit.jsonl")
+        if session.journal.needs_compaction():
+            session.journal.compact()
+    except OSError:
+        # Read-only location, annotations are only kept in memory until saved
+        session.journal = None
+    return session
+
+
+class Workspace:
+    def __init__(self, max_open_documents=8, idle_seconds=300, on_close=None):
+        self.max_open_documents = max_open_documents
+        self.idle_seconds = idle_seconds
+        self.on_close = on_close  # Called with a session after its fitz document was closed
+        self.sessions = OrderedDict()  # key -> DocumentSession, least recently used first
+        self.active = None
+
+    def find(self, path):
+        return self.sessions.get(os.path.abspath(path))
+
+    def add(self, session):
+        # Register a session opened in the background; keeps the existing one if it was opened meanwhile
+        return self.sessions.setdefault(session.key, session)
+
+    def activate(self, session):
+        if session.document is None:
+            with FITZ_LOCK:
+                session.document = fitz.open(session.path)
+        session.last_used = time.monotonic()
+        self.sessions.move_to_end(session.key)
+        self.active = session
+        self.evict_idle()
+        return session
+
+    def evict_idle(self):
+        # Close fitz handles of documents idle for too long, or beyond the number kept open
+        now = time.monotonic()
+        open_sessions = [s for s in self.sessions.values() if s.document is not None and s is not self.active]
+        excess = len(open_sessions) + 1 - self.max_open_documents
+        for idx, session in enumerate(open_sessions):  # Least recently used first
+            if idx < excess or now - session.last_used > self.idle_seconds:
+                self.close_document(session)
+
+    def close_document(self, session):
+        with FITZ_LOCK:
+            session.document.close()
+        session.document = None
+        if self.on_close is not None:
+            self.on_close(session)
+
+    def close(self, session):
+        # Remove a document from the workspace entirely
+        if session.document is not None:
+            self.close_document(session)
+        if session.journal is not None:
+            session.journal.close()
+        self.sessions.pop(session.key, None)
+        if self.active is session:
+            self.active = None
+
+    def close_all(self):
+        for session in list(self.sessions.values()):
+            self.close(session)